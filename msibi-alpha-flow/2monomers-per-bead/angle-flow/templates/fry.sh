@@ -1,6 +1,9 @@
 {% extends "base_script.sh" %}
 {% block header %}
 {% set gpus = operations|map(attribute='directives.ngpu')|sum %}
+{% if jobs_per_gpu and jobs_per_gpu > 1 %}
+{% set gpus = (gpus / jobs_per_gpu)|round(0, 'ceil')|int %}
+{% endif %}
 #!/bin/bash
 #SBATCH --job-name="{{ id }}"
 {% if partition %}
@@ -20,3 +23,24 @@
 #SBATCH --ntasks={{ np_global }}
 {% endblock %}
 {% endblock %}
+{% block project_header %}
+{{ super() }}
+{% if jobs_per_gpu and jobs_per_gpu > 1 %}
+# Let the bundled operations share the GPU through CUDA MPS
+export JOBS_PER_GPU={{ jobs_per_gpu }}
+export CUDA_MPS_PIPE_DIRECTORY=/tmp/mps-pipe-$SLURM_JOB_ID
+export CUDA_MPS_LOG_DIRECTORY=/tmp/mps-log-$SLURM_JOB_ID
+nvidia-cuda-mps-control -d
+trap 'echo quit | nvidia-cuda-mps-control' EXIT
+{% if operations|length > jobs_per_gpu %}
+# GPUs allocated to this job, the operations below number them from 0
+export ALLOCATED_GPUS=${CUDA_VISIBLE_DEVICES:-}
+{% endif %}
+{% endif %}
+{% endblock %}
+{% block pre_operation %}
+{% if jobs_per_gpu and jobs_per_gpu > 1 and operations|length > jobs_per_gpu %}
+{# MPS clients number the GPUs of the allocation from 0 #}
+export CUDA_VISIBLE_DEVICES={{ loop.index0 // jobs_per_gpu }}
+{% endif %}
+{% endblock pre_operation %}
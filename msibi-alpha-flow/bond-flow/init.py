@@ -77,6 +77,13 @@ def main():
         job = project.open_job(statepoint)
         job.init()
         job.doc.setdefault("done", False)
+        # Set to a number of cores to run the optimization on the CPU instead
+        # of a GPU, and to a distance or "tune" to set the nlist buffer
+        job.doc.setdefault("cpu_threads", None)
+        job.doc.setdefault("nlist_buffer", None)
+        # Set to True to run the CG simulations of all states of an iteration
+        # at the same time, each in its own process
+        job.doc.setdefault("parallel_states", False)
 
 
 if __name__ == "__main__":
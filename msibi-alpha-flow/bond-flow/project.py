@@ -13,6 +13,8 @@ import signac
 from flow import FlowProject
 from flow.environment import DefaultSlurmEnvironment
 
+from utils.gpu import GPUMonitorHooks, ngpu_directive, np_directive
+
 
 class BondMSIBI(FlowProject):
     pass
@@ -28,6 +30,10 @@ class Borah(DefaultSlurmEnvironment):
             "--partition", default="gpu",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 class Fry(DefaultSlurmEnvironment):
@@ -40,6 +46,10 @@ class Fry(DefaultSlurmEnvironment):
             "--partition", default="batch," "v100",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 # Definition of project-related labels (classification)
@@ -54,10 +64,16 @@ def get_file(job, file_name):
 
 @BondMSIBI.post(completed)
 @BondMSIBI.operation(
-    directives={"ngpu": 1, "executable": "python -u"}, name="optimize"
+    directives={
+        "ngpu": ngpu_directive,
+        "np": np_directive,
+        "executable": "python -u"
+    },
+    name="optimize"
 )
 def optimize(job):
-    from msibi import MSIBI, State, Bond
+    from msibi import State, Bond
+    from utils.optimizer import MSIBIOptimizer
     import hoomd
     import os
 
@@ -66,7 +82,7 @@ def optimize(job):
             dir_path = job.fn("states")
             os.system(f"rm -r {dir_path}")
         print("Setting up MSIBI optimizer...")
-        opt = MSIBI(
+        opt = MSIBIOptimizer(
             nlist=job.sp.nlist,
             integrator_method=hoomd.md.methods.ConstantVolume,
             method_kwargs={},
@@ -75,6 +91,10 @@ def optimize(job):
             dt=job.sp.dt,
             gsd_period=job.sp.n_steps[0] // 500,
             nlist_exclusions=job.sp.nlist_exclusions,
+            parallel_states=job.doc.get("parallel_states", False),
+            device="cpu" if job.doc.get("cpu_threads") else None,
+            num_cpu_threads=job.doc.get("cpu_threads"),
+            nlist_buffer=job.doc.get("nlist_buffer"),
         )
 
         print("Creating State objects...")
@@ -168,4 +188,6 @@ def optimize(job):
 
 
 if __name__ == "__main__":
-    BondMSIBI(environment=Fry).main()
+    project = BondMSIBI(environment=Fry)
+    GPUMonitorHooks(operations=["optimize"]).install_project_hooks(project)
+    project.main()
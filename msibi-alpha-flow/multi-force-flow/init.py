@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""Initialize the project's data space.
+
+Iterates over all defined state points and initializes
+the associated job workspace directories.
+The result of running this file is the creation of a signac workspace:
+    - signac.rc file containing the project name
+    - signac_statepoints.json summary for the entire workspace
+    - workspace/ directory that contains a sub-directory of every individual statepoint
+    - signac_statepoints.json within each individual statepoint sub-directory.
+"""
+
+import logging
+from collections import OrderedDict
+from itertools import product
+
+import numpy as np
+import signac
+
+
+def get_parameters(ordered_dict=OrderedDict()):
+    '''Use the listed parameters below to set up
+    your MSIBI instructions.
+
+    Bonds, angles and pairs are all optimized at once, from the same state
+    simulations, instead of in separate bond-flow, angle-flow and pair-flow
+    projects.
+    '''
+    parameters = ordered_dict
+
+    # Optimizer parameters
+    parameters["thermostat_tau"] = [0.03]
+    parameters["dt"] = [0.0003]
+    parameters["r_cut"] = [4.0]
+    parameters["nlist_exclusions"] = [["bond", "angle"]]
+    parameters["n_steps"] = [[5e5, 1e6, 2e6]]
+    parameters["state_alphas"] = [
+        [
+            [0.75, 0.75, 0.75],
+            [0.75, 0.75, 0.75],
+            [0.75, 0.75, 0.75],
+        ]
+    ]
+    parameters["n_iterations"] = [[20, 20, 20]]
+    parameters["epsilon"] = [1.25]
+    parameters["sigma"] = [1.5]
+
+    # State parameters
+    # For each state: path to project with target trajectories,
+    # and the job ID state point from pair_target_project.
+    parameters["states"] = [
+        [
+            {"name": "BelowTg",
+             "n_frames": 50,
+             "target_project": "/home/erjank_project/PPS-MSIBI/pps-msibi/validation",
+             "target_job_id": "1cbc57c38be8cfe0ae9994bcb19467e2",
+             "cg_file_name": "target_1monomer_per_bead.gsd",
+             },
+
+            {"name": "AmorphousTg",
+             "n_frames": 50,
+             "target_project": "/home/erjank_project/PPS-MSIBI/pps-msibi/validation",
+             "target_job_id": "39edcdb395b6b0d3c3028c6feb7547af",
+             "cg_file_name": "target_1monomer_per_bead.gsd",
+             },
+
+            {"name": "Melted",
+             "n_frames": 50,
+             "target_project": "/home/erjank_project/PPS-MSIBI/pps-msibi/validation",
+             "target_job_id": "212e36add95bb5744b05aa8ce8d29449",
+             "cg_file_name": "target_1monomer_per_bead.gsd",
+             },
+        ],
+    ]
+
+    # Pair parameters
+    parameters["pairs_nbins"] = [100]
+    parameters["pairs"] = [
+            {"type1": "A",
+             "type2": "A",
+             },
+    ]
+    # Bond parameters
+    parameters["bonds_nbins"] = [60]
+    parameters["bonds"] = [
+            {"type1": "A",
+             "type2": "A",
+             "x0": 1.5,
+             "x_min": 0,
+             "x_max": 3.0,
+             "k4": 0,
+             "k3": 0,
+             "k2": 400
+             }
+    ]
+    # Angle parameters
+    parameters["angles_nbins"] = [100]
+    parameters["angles"] = [
+            {"type1": "A",
+             "type2": "A",
+             "type3": "A",
+             "x0": 2.2,
+             "x_min": 0,
+             "x_max": np.pi,
+             "k4": 0,
+             "k3": 0,
+             "k2": 200,
+             },
+    ]
+    parameters["smoothing_window"] = [7]
+
+    return list(parameters.keys()), list(product(*parameters.values()))
+
+
+def main():
+    project = signac.init_project()  # Set the signac project name
+    param_names, param_combinations = get_parameters()
+    # Create the generate jobs
+    for params in param_combinations:
+        statepoint = dict(zip(param_names, params))
+        job = project.open_job(statepoint)
+        job.init()
+        job.doc.setdefault("done", False)
+        # Set to a number of cores to run the optimization on the CPU instead
+        # of a GPU, and to a distance or "tune" to set the nlist buffer
+        job.doc.setdefault("cpu_threads", None)
+        job.doc.setdefault("nlist_buffer", None)
+        # Start every iteration's CG runs from the previous iteration's last
+        # frame, and drop the query frames of the first discard_steps
+        job.doc.setdefault("warm_start", False)
+        job.doc.setdefault("discard_steps", 0)
+        # Build query distributions during the CG runs instead of from
+        # their trajectories
+        job.doc.setdefault("accumulate_distributions", False)
+        # Set to True to run the CG simulations of all states of an iteration
+        # at the same time, each in its own process
+        job.doc.setdefault("parallel_states", False)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
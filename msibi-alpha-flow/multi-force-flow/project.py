@@ -0,0 +1,262 @@
+"""Define the project's workflow logic and operation functions.
+
+Execute this script directly from the command line, to view your project's
+status, execute operations and submit them to a cluster. See also:
+
+    $ python src/project.py --help
+
+"""
+
+import os
+
+import signac
+from flow import FlowProject, directives
+from flow.environment import DefaultSlurmEnvironment
+
+from utils.gpu import GPUMonitorHooks, ngpu_directive, np_directive
+
+
+class MultiForceMSIBI(FlowProject):
+    pass
+
+
+class Borah(DefaultSlurmEnvironment):
+    hostname_pattern = "borah"
+    template = "borah.sh"
+
+    @classmethod
+    def add_args(cls, parser):
+        parser.add_argument(
+            "--partition", default="gpu",
+            help="Specify the partition to submit to."
+        )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
+
+
+class Fry(DefaultSlurmEnvironment):
+    hostname_pattern = "fry"
+    template = "fry.sh"
+
+    @classmethod
+    def add_args(cls, parser):
+        parser.add_argument(
+            "--partition", default="batch",
+            help="Specify the partition to submit to."
+        )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
+
+
+# Definition of project-related labels (classification)
+@MultiForceMSIBI.label
+def completed(job):
+    return job.doc.get("done")
+
+
+@MultiForceMSIBI.post(completed)
+@MultiForceMSIBI.operation(
+    directives={
+        "ngpu": ngpu_directive,
+        "np": np_directive,
+        "executable": "python -u"
+    },
+    name="optimize"
+)
+def optimize(job):
+    """Optimize the bond, angle and pair potentials together.
+
+    Every iteration runs one simulation per state and updates all three
+    tables from the distributions sampled in that same run.
+    """
+    from msibi import State, Bond, Angle, Pair
+    from utils.optimizer import MSIBIOptimizer, checkpoint_progress
+    import hoomd
+    import os
+
+    with job:
+        print("Starting MSIBI Optimization for job:")
+        print(job.id)
+        job.doc["done"] = False
+        progress = checkpoint_progress(job.fn("checkpoint"))
+        if os.path.exists(job.fn("states")):
+            dir_path = job.fn("states")
+            # msibi needs an empty states directory; when resuming, keep the
+            # query trajectories of the completed iterations next to it
+            backup_path = None
+            if progress is not None:
+                backup_path = job.fn(f"states-{progress['n_iterations']}")
+            if backup_path is None or os.path.exists(backup_path):
+                os.system(f"rm -r {dir_path}")
+            else:
+                os.rename(dir_path, backup_path)
+        print("Setting up MSIBI optimizer...")
+        opt = MSIBIOptimizer(
+            nlist=hoomd.md.nlist.Cell,
+            integrator_method=hoomd.md.methods.ConstantVolume,
+            method_kwargs={},
+            thermostat=hoomd.md.methods.thermostats.MTTK,
+            thermostat_kwargs={"tau": job.sp.thermostat_tau},
+            dt=job.sp.dt,
+            gsd_period=job.sp.n_steps[0] // 200,
+            nlist_exclusions=job.sp.nlist_exclusions,
+            parallel_states=job.doc.get("parallel_states", False),
+            device="cpu" if job.doc.get("cpu_threads") else None,
+            num_cpu_threads=job.doc.get("cpu_threads"),
+            nlist_buffer=job.doc.get("nlist_buffer"),
+            checkpoint_dir=job.fn("checkpoint"),
+            warm_start=job.doc.get("warm_start", False),
+            discard_steps=job.doc.get("discard_steps", 0),
+            accumulate_distributions=job.doc.get(
+                "accumulate_distributions", False
+            ),
+        )
+
+        print("Creating State objects...")
+        for state in job.sp.states:
+            print("State: ", state)
+            target_project = signac.get_project(state["target_project"])
+            target_state_job = target_project.open_job(
+                    id=state["target_job_id"]
+            )
+            print("Target Job:", target_state_job)
+            gsd_file = target_state_job.fn(state["cg_file_name"])
+            print("Target gsd: ", gsd_file)
+            print()
+            state = State(
+                name=state["name"],
+                kT=target_state_job.sp.kT,
+                traj_file=gsd_file,
+                n_frames=state["n_frames"],
+                alpha0=1.0,
+                alpha_form="linear",
+            )
+            opt.add_state(state)
+
+        print("Creating Bond objects...")
+        AA_bond = Bond(
+            type1=job.sp.bonds["type1"],
+            type2=job.sp.bonds["type2"],
+            optimize=True,
+            nbins=job.sp.bonds_nbins,
+        )
+        AA_bond.set_quadratic(
+            x0=job.sp.bonds["x0"],
+            x_min=job.sp.bonds["x_min"],
+            x_max=job.sp.bonds["x_max"],
+            k2=job.sp.bonds["k2"],
+            k3=job.sp.bonds["k3"],
+            k4=job.sp.bonds["k4"],
+        )
+        opt.add_force(AA_bond)
+
+        print("Creating Angle objects...")
+        AAA_angle = Angle(
+            type1=job.sp.angles["type1"],
+            type2=job.sp.angles["type2"],
+            type3=job.sp.angles["type3"],
+            optimize=True,
+            nbins=job.sp.angles_nbins,
+        )
+        AAA_angle.set_quadratic(
+            x0=job.sp.angles["x0"],
+            x_min=job.sp.angles["x_min"],
+            x_max=job.sp.angles["x_max"],
+            k2=job.sp.angles["k2"],
+            k3=job.sp.angles["k3"],
+            k4=job.sp.angles["k4"],
+        )
+        opt.add_force(AAA_angle)
+
+        print("Creating Pair objects...")
+        AA_pair = Pair(
+                type1=job.sp.pairs["type1"],
+                type2=job.sp.pairs["type2"],
+                r_cut=job.sp.r_cut,
+                nbins=job.sp.pairs_nbins,
+                exclude_bonded=True,
+                optimize=True
+        )
+        AA_pair.set_lj(
+                epsilon=job.sp.epsilon,
+                sigma=job.sp.sigma,
+                r_min=0.1,
+                r_cut=job.sp.r_cut
+        )
+        opt.add_force(AA_pair)
+
+        # Bonds and pairs share the A-A name, so file names get the kind too
+        forces = {"bond": AA_bond, "angle": AAA_angle, "pair": AA_pair}
+        for force in forces.values():
+            force.smoothing_window = job.sp.smoothing_window
+
+        if opt.load_checkpoint():
+            print(
+                f"Resuming from stage {opt.stage}, "
+                f"iteration {opt.stage_iteration}"
+            )
+
+        print("Running Optimization...")
+        for stage, (n_iterations, n_steps, alphas) in enumerate(zip(
+                job.sp.n_iterations,
+                job.sp.n_steps,
+                job.sp.state_alphas
+        )):
+            if stage < opt.stage:
+                continue
+            print("ALPHAS")
+            print(alphas)
+            for idx, state in enumerate(opt.states):
+                state.alpha0 = alphas[idx]
+            opt.run_optimization(
+                    n_steps=n_steps,
+                    n_iterations=n_iterations,
+                    backup_trajectories=True,
+                    stage=stage
+            )
+            for force in forces.values():
+                force.smooth_potential()
+            opt.save_checkpoint(stage=stage + 1)
+
+        # save the optimized potentials to file
+        for kind, force in forces.items():
+            prefix = f"{force.name}_{kind}"
+            force.save_potential(job.fn(f"{prefix}.csv"))
+            force.save_potential_history(
+                job.fn(f"{prefix}_potential_history.npy")
+            )
+            force.plot_potentials(file_path=job.fn(f"{prefix}_potential.png"))
+            force.plot_potential_history(
+                file_path=job.fn(f"{prefix}_potential_history.png")
+            )
+
+        # save plots to file
+        for state in opt.states:
+            for kind, force in forces.items():
+                prefix = f"{state.name}_{force.name}_{kind}"
+                force.save_state_data(
+                        state=state,
+                        file_path=job.fn(f"state_{prefix}_data.npz")
+                )
+                force.plot_fit_scores(
+                        state=state,
+                        file_path=job.fn(f"{prefix}_fitscore.png")
+                )
+                force.plot_distribution_comparison(
+                        state=state,
+                        file_path=job.fn(f"{prefix}_dist_comparison.png")
+                )
+        opt.pickle_forces(job.fn("pps-msibi.pickle"))
+
+        print("Optimization done")
+        job.doc["done"] = True
+
+
+if __name__ == "__main__":
+    project = MultiForceMSIBI(environment=Fry)
+    GPUMonitorHooks(operations=["optimize"]).install_project_hooks(project)
+    project.main()
@@ -0,0 +1,4 @@
+{% extends base_script %}
+{% block project_header %}
+{{ super() }}
+{% endblock %}
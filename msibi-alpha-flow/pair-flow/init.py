@@ -18,6 +18,21 @@ import numpy as np
 import signac
 
 
+# Example arguments to MSIBIOptimizer.run_adaptive_optimization, not applied
+# by default. To use them, set a job's "adaptive_schedule" document entry to
+# this dict. The optimize operation then ignores the fixed
+# n_iterations/n_steps stages below, runs with the first n_steps and
+# state_alphas entries only (the alphas of later stages are dropped), and
+# stops once the fit scores converge.
+ADAPTIVE_SCHEDULE = {
+    "max_steps": 2e6,
+    "max_iterations": 150,
+    "fit_tolerance": 1e-3,
+    "patience": 5,
+    "smoothing_period": 10,
+}
+
+
 def get_parameters(ordered_dict=OrderedDict()):
     '''Use the listed parameters below to set up
     your MSIBI instructions.
@@ -192,6 +207,22 @@ def main():
         job = project.open_job(statepoint)
         job.init()
         job.doc.setdefault("done", False)
+        # Set to a number of cores to run the optimization on the CPU instead
+        # of a GPU, and to a distance or "tune" to set the nlist buffer
+        job.doc.setdefault("cpu_threads", None)
+        job.doc.setdefault("nlist_buffer", None)
+        # Start every iteration's CG runs from the previous iteration's last
+        # frame, and drop the query frames of the first discard_steps
+        job.doc.setdefault("warm_start", False)
+        job.doc.setdefault("discard_steps", 0)
+        # Build query distributions during the CG runs instead of from
+        # their trajectories
+        job.doc.setdefault("accumulate_distributions", False)
+        # None runs the fixed stages, see ADAPTIVE_SCHEDULE to opt in
+        job.doc.setdefault("adaptive_schedule", None)
+        # Set to True to run the CG simulations of all states of an iteration
+        # at the same time, each in its own process
+        job.doc.setdefault("parallel_states", False)
 
 
 if __name__ == "__main__":
@@ -13,6 +13,8 @@ import signac
 from flow import FlowProject, directives
 from flow.environment import DefaultSlurmEnvironment
 
+from utils.gpu import GPUMonitorHooks, ngpu_directive, np_directive
+
 
 class AngleMSIBI(FlowProject):
     pass
@@ -28,6 +30,10 @@ class Borah(DefaultSlurmEnvironment):
             "--partition", default="gpu",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 class Fry(DefaultSlurmEnvironment):
@@ -40,6 +46,10 @@ class Fry(DefaultSlurmEnvironment):
             "--partition", default="batch",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 # Definition of project-related labels (classification)
@@ -55,10 +65,16 @@ def get_file(job, file_name):
 
 @AngleMSIBI.post(completed)
 @AngleMSIBI.operation(
-    directives={"ngpu": 1, "executable": "python -u"}, name="optimize"
+    directives={
+        "ngpu": ngpu_directive,
+        "np": np_directive,
+        "executable": "python -u"
+    },
+    name="optimize"
 )
 def optimize(job):
-    from msibi import MSIBI, State, Bond, Angle
+    from msibi import State, Bond, Angle
+    from utils.optimizer import MSIBIOptimizer
     import hoomd
     import os
     import numpy as np
@@ -70,7 +86,7 @@ def optimize(job):
             os.system(f"rm -r {dir_path}")
 
         print("Setting up MSIBI optimizer...")
-        opt = MSIBI(
+        opt = MSIBIOptimizer(
             nlist=job.sp.nlist,
             integrator_method=hoomd.md.methods.ConstantVolume,
             method_kwargs={},
@@ -79,6 +95,10 @@ def optimize(job):
             dt=job.sp.dt,
             gsd_period=job.sp.n_steps[0] // 500,
             nlist_exclusions=None,
+            parallel_states=job.doc.get("parallel_states", False),
+            device="cpu" if job.doc.get("cpu_threads") else None,
+            num_cpu_threads=job.doc.get("cpu_threads"),
+            nlist_buffer=job.doc.get("nlist_buffer"),
         )
 
         print("Creating State objects...")
@@ -192,4 +212,6 @@ def optimize(job):
 
 
 if __name__ == "__main__":
-    AngleMSIBI(environment=Fry).main()
+    project = AngleMSIBI(environment=Fry)
+    GPUMonitorHooks(operations=["optimize"]).install_project_hooks(project)
+    project.main()
@@ -13,6 +13,8 @@ import signac
 from flow import FlowProject, directives
 from flow.environment import DefaultSlurmEnvironment
 
+from utils.gpu import GPUMonitorHooks, ngpu_directive, np_directive
+
 
 class PairMSIBI(FlowProject):
     pass
@@ -28,6 +30,10 @@ class Borah(DefaultSlurmEnvironment):
             "--partition", default="gpu",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 class Fry(DefaultSlurmEnvironment):
@@ -40,6 +46,10 @@ class Fry(DefaultSlurmEnvironment):
             "--partition", default="batch",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 # Definition of project-related labels (classification)
@@ -55,10 +65,16 @@ def get_file(job, file_name):
 
 @PairMSIBI.post(completed)
 @PairMSIBI.operation(
-    directives={"ngpu": 1, "executable": "python -u"}, name="optimize"
+    directives={
+        "ngpu": ngpu_directive,
+        "np": np_directive,
+        "executable": "python -u"
+    },
+    name="optimize"
 )
 def optimize(job):
-    from msibi import MSIBI, State, Bond, Angle, Pair
+    from msibi import State, Bond, Angle, Pair
+    from utils.optimizer import MSIBIOptimizer
     import hoomd
     import os
     import numpy as np
@@ -71,7 +87,7 @@ def optimize(job):
             dir_path = job.fn("states")
             os.system(f"rm -r {dir_path}")
         print("Setting up MSIBI optimizer...")
-        opt = MSIBI(
+        opt = MSIBIOptimizer(
             nlist=hoomd.md.nlist.Cell,
             integrator_method=hoomd.md.methods.ConstantVolume,
             method_kwargs={},
@@ -80,6 +96,10 @@ def optimize(job):
             dt=job.sp.dt,
             gsd_period=job.sp.n_steps[0] // 200,
             nlist_exclusions=job.sp.nlist_exclusions,
+            parallel_states=job.doc.get("parallel_states", False),
+            device="cpu" if job.doc.get("cpu_threads") else None,
+            num_cpu_threads=job.doc.get("cpu_threads"),
+            nlist_buffer=job.doc.get("nlist_buffer"),
         )
 
         print("Creating State objects...")
@@ -223,4 +243,6 @@ def optimize(job):
 
 
 if __name__ == "__main__":
-    PairMSIBI(environment=Fry).main()
+    project = PairMSIBI(environment=Fry)
+    GPUMonitorHooks(operations=["optimize"]).install_project_hooks(project)
+    project.main()
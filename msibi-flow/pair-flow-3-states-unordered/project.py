@@ -13,6 +13,8 @@ import signac
 from flow import FlowProject, directives
 from flow.environment import DefaultSlurmEnvironment
 
+from utils.gpu import GPUMonitorHooks, ngpu_directive, np_directive
+
 
 class PairMSIBI(FlowProject):
     pass
@@ -28,6 +30,10 @@ class Borah(DefaultSlurmEnvironment):
             "--partition", default="gpu",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 class Fry(DefaultSlurmEnvironment):
@@ -40,6 +46,10 @@ class Fry(DefaultSlurmEnvironment):
             "--partition", default="batch",
             help="Specify the partition to submit to."
         )
+        parser.add_argument(
+            "--jobs-per-gpu", type=int, default=1,
+            help="Number of bundled operations to share each GPU."
+        )
 
 
 # Definition of project-related labels (classification)
@@ -55,10 +65,16 @@ def get_file(job, file_name):
 
 @PairMSIBI.post(completed)
 @PairMSIBI.operation(
-    directives={"ngpu": 1, "executable": "python -u"}, name="optimize"
+    directives={
+        "ngpu": ngpu_directive,
+        "np": np_directive,
+        "executable": "python -u"
+    },
+    name="optimize"
 )
 def optimize(job):
-    from msibi import MSIBI, State, Bond, Angle, Pair
+    from msibi import State, Bond, Angle, Pair
+    from utils.optimizer import MSIBIOptimizer, checkpoint_progress
     import hoomd
     import os
     import numpy as np
@@ -67,11 +83,20 @@ def optimize(job):
         print("Starting MSIBI Optimization for job:")
         print(job.id)
         job.doc["done"] = False
+        progress = checkpoint_progress(job.fn("checkpoint"))
         if os.path.exists(job.fn("states")):
             dir_path = job.fn("states")
-            os.system(f"rm -r {dir_path}")
+            # msibi needs an empty states directory; when resuming, keep the
+            # query trajectories of the completed iterations next to it
+            backup_path = None
+            if progress is not None:
+                backup_path = job.fn(f"states-{progress['n_iterations']}")
+            if backup_path is None or os.path.exists(backup_path):
+                os.system(f"rm -r {dir_path}")
+            else:
+                os.rename(dir_path, backup_path)
         print("Setting up MSIBI optimizer...")
-        opt = MSIBI(
+        opt = MSIBIOptimizer(
             nlist=hoomd.md.nlist.Cell,
             integrator_method=hoomd.md.methods.ConstantVolume,
             method_kwargs={},
@@ -80,6 +105,16 @@ def optimize(job):
             dt=job.sp.dt,
             gsd_period=job.sp.n_steps[0] // 200,
             nlist_exclusions=job.sp.nlist_exclusions,
+            parallel_states=job.doc.get("parallel_states", False),
+            device="cpu" if job.doc.get("cpu_threads") else None,
+            num_cpu_threads=job.doc.get("cpu_threads"),
+            nlist_buffer=job.doc.get("nlist_buffer"),
+            checkpoint_dir=job.fn("checkpoint"),
+            warm_start=job.doc.get("warm_start", False),
+            discard_steps=job.doc.get("discard_steps", 0),
+            accumulate_distributions=job.doc.get(
+                "accumulate_distributions", False
+            ),
         )
 
         print("Creating State objects...")
@@ -153,12 +188,20 @@ def optimize(job):
         AA_pair.smoothing_window = 5
         opt.add_force(AA_pair)
 
+        if opt.load_checkpoint():
+            print(
+                f"Resuming from stage {opt.stage}, "
+                f"iteration {opt.stage_iteration}"
+            )
+
         print("Running Optimization...")
-        for n_iterations, n_steps, alphas in zip(
+        for stage, (n_iterations, n_steps, alphas) in enumerate(zip(
                 job.sp.n_iterations,
                 job.sp.n_steps,
                 job.sp.state_alphas
-        ):
+        )):
+            if stage < opt.stage:
+                continue
             print("ALPHAS")
             print(alphas)
             for idx, state in enumerate(opt.states):
@@ -166,10 +209,12 @@ def optimize(job):
             opt.run_optimization(
                     n_steps=n_steps,
                     n_iterations=n_iterations,
-                    backup_trajectories=True
+                    backup_trajectories=True,
+                    stage=stage
             )
             AA_pair.smooth_potential()
             AA_pair.save_potential(job.fn(f"pair_pot.csv"))
+            opt.save_checkpoint(stage=stage + 1)
 
         # save the optimized pairs to file
         AA_pair.save_potential(job.fn(f"{AA_pair.name}_pair.csv"))
@@ -219,4 +264,6 @@ def optimize(job):
 
 
 if __name__ == "__main__":
-    PairMSIBI(environment=Fry).main()
+    project = PairMSIBI(environment=Fry)
+    GPUMonitorHooks(operations=["optimize"]).install_project_hooks(project)
+    project.main()
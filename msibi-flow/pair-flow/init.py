@@ -192,6 +192,20 @@ def main():
         job = project.open_job(statepoint)
         job.init()
         job.doc.setdefault("done", False)
+        # Set to a number of cores to run the optimization on the CPU instead
+        # of a GPU, and to a distance or "tune" to set the nlist buffer
+        job.doc.setdefault("cpu_threads", None)
+        job.doc.setdefault("nlist_buffer", None)
+        # Start every iteration's CG runs from the previous iteration's last
+        # frame, and drop the query frames of the first discard_steps
+        job.doc.setdefault("warm_start", False)
+        job.doc.setdefault("discard_steps", 0)
+        # Build query distributions during the CG runs instead of from
+        # their trajectories
+        job.doc.setdefault("accumulate_distributions", False)
+        # Set to True to run the CG simulations of all states of an iteration
+        # at the same time, each in its own process
+        job.doc.setdefault("parallel_states", False)
 
 
 if __name__ == "__main__":
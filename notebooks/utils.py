@@ -1,9 +1,63 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import matplotlib.pyplot as plt
 import numpy as np
 import signac
 from cmeutils.sampling import equil_sample
 
 
+def _log_equilibrium_results(
+		sample_data,
+		trim_cut,
+		log_write_freq,
+		gsd_write_freq,
+		threshold_fraction,
+		threshold_neff,
+):
+    """Run equil_sample on log data and return the job doc fields to set.
+
+    Raises a ValueError if the data is not equilibrated.
+    """
+    uncorr_sample, uncorr_indices, prod_start, Neff = equil_sample(
+        sample_data[trim_cut:],
+        threshold_fraction=threshold_fraction,
+        threshold_neff=threshold_neff
+    )
+    results = dict()
+    # Job is equilibrated
+    results["equilibrated"] = True
+    # Starting index to use for log file
+    results["log_equil_start"] = int(trim_cut + prod_start)
+    # Starting time step to use when sampling
+    results["equil_step_start"] = int(results["log_equil_start"] * log_write_freq)
+    # Number of equilibrated samples
+    results["log_equil_Neff"] = int(Neff)
+    # Index stride to use when sampling from log file
+    results["equil_log_stride"] = int(uncorr_indices[1] - uncorr_indices[0])
+    # Time step stride to use when sampling
+    results["equil_step_stride"] = int(results["equil_log_stride"] * log_write_freq)
+    if results["equil_step_stride"] > gsd_write_freq:
+        results["equil_gsd_stride"] = int(results["equil_step_stride"] // gsd_write_freq)
+    else:
+        results["equil_gsd_stride"] = 1
+    if results["equil_step_start"] > gsd_write_freq:
+        results["equil_gsd_start"] = int(results["equil_step_start"] // gsd_write_freq)
+    else:
+        results["equil_gsd_start"] = 1
+    return results
+
+
+def _check_log_for_equilibrium(args):
+    """Process pool worker used by check_project_for_log_equilibrium."""
+    job_id, log_path, value, kwargs = args
+    sample_data = np.genfromtxt(log_path, names=True)[value]
+    try:
+        return job_id, _log_equilibrium_results(sample_data, **kwargs)
+    except ValueError:
+        return job_id, None
+
+
 def check_job_for_log_equilibrium(
 		job,
 		trim_cut,
@@ -15,32 +69,62 @@ def check_job_for_log_equilibrium(
     all_data = np.genfromtxt(log_path, names=True)
     sample_data = all_data[value]
     try:
-        uncorr_sample, uncorr_indices, prod_start, Neff = equil_sample(
-            sample_data[trim_cut:],
+        results = _log_equilibrium_results(
+            sample_data,
+            trim_cut=trim_cut,
+            log_write_freq=job.sp.log_write_freq,
+            gsd_write_freq=job.sp.gsd_write_freq,
             threshold_fraction=threshold_fraction,
             threshold_neff=threshold_neff
         )
-        # Job is equilibrated
-        job.doc.equilibrated = True
-        # Starting index to use for log file
-        job.doc.log_equil_start = int(trim_cut + prod_start)
-        # Starting time step to use when sampling
-        job.doc.equil_step_start = int(job.doc.log_equil_start * job.sp.log_write_freq)
-        # Number of equilibrated samples
-        job.doc.log_equil_Neff = int(Neff)
-        # Index stride to use when sampling from log file
-        job.doc.equil_log_stride = int(uncorr_indices[1] - uncorr_indices[0])
-        # Time step stride to use when sampling
-        job.doc.equil_step_stride = int(job.doc.equil_log_stride * job.sp.log_write_freq)
-        if job.doc.equil_step_stride > job.sp.gsd_write_freq:
-            job.doc.equil_gsd_stride = int(job.doc.equil_step_stride // job.sp.gsd_write_freq)
-        else:
-            job.doc.equil_gsd_stride = 1
-        if job.doc.equil_step_start > job.sp.gsd_write_freq:
-            job.doc.equil_gsd_start = int(job.doc.equil_step_start // job.sp.gsd_write_freq)
-        else:
-            job.doc.equil_gsd_start = 1
+        job.doc.update(results)
     except ValueError:
         print("Not equilibrated:")
         print(job.id)
         print()
+
+
+def check_project_for_log_equilibrium(
+		project,
+		trim_cut,
+		job_filter=None,
+		threshold_fraction=0.25,
+		threshold_neff=50,
+		value="mdcomputeThermodynamicQuantitiespotential_energy",
+		n_processes=None,
+):
+    """Run check_job_for_log_equilibrium on every matching job at once.
+
+    The log files are read and analyzed across a process pool, then each
+    job document gets all of its equilibration fields in a single update.
+
+    Returns a dict of job id: bool, True if the job is equilibrated.
+    """
+    jobs = {job.id: job for job in project.find_jobs(filter=job_filter)}
+    tasks = []
+    for job in jobs.values():
+        kwargs = dict(
+            trim_cut=trim_cut,
+            log_write_freq=job.sp.log_write_freq,
+            gsd_write_freq=job.sp.gsd_write_freq,
+            threshold_fraction=threshold_fraction,
+            threshold_neff=threshold_neff,
+        )
+        log_path = job.fn(f"log{job.doc.runs - 1}.txt")
+        tasks.append((job.id, log_path, value, kwargs))
+
+    if n_processes is None:
+        n_processes = min(len(tasks), os.cpu_count()) or 1
+    with ProcessPoolExecutor(max_workers=n_processes) as executor:
+        all_results = dict(executor.map(_check_log_for_equilibrium, tasks))
+
+    equilibrated = dict()
+    for job_id, results in all_results.items():
+        equilibrated[job_id] = results is not None
+        if results is None:
+            print("Not equilibrated:")
+            print(job_id)
+            print()
+            continue
+        jobs[job_id].doc.update(results)
+    return equilibrated
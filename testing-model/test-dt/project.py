@@ -63,6 +63,20 @@ def production_done(job):
     return job.isfile("production-restart.gsd")
 
 
+@PPSCG.label
+def unwrapped(job):
+    from utils.trajectory import UnwrappedTrajectory
+    return UnwrappedTrajectory.for_gsd(job.fn("production.gsd")) is not None
+
+
+def unwrap_requested(job):
+    return job.doc.get("unwrap_production", False)
+
+
+def unwrap_done(job):
+    return unwrapped(job) or not unwrap_requested(job)
+
+
 def get_ref_values(job):
     ref_length = 0.3438 * Unit("nm")
     ref_mass = 32.06 * Unit("amu")
@@ -307,6 +321,27 @@ def production_run(job):
 
 
 @PPSCG.pre(production_done)
+@PPSCG.pre(unwrap_requested)
+@PPSCG.post(unwrapped)
+@PPSCG.operation(
+    directives={"ngpu": 0, "executable": "python -u"},
+    name="unwrap"
+)
+def unwrap(job):
+    """Convert production.gsd to a memory mapped store of unwrapped
+    positions that sample and later analyses read instead of the GSD."""
+    from utils.trajectory import write_unwrapped
+    with job:
+        print("------------------------------------")
+        print("JOB ID NUMBER:")
+        print(job.id)
+        print("------------------------------------")
+        store = write_unwrapped(job.fn("production.gsd"))
+        print(f"Wrote {len(store)} frames to {store.prefix}-*")
+
+
+@PPSCG.pre(production_done)
+@PPSCG.pre(unwrap_done)
 @PPSCG.post(sampled)
 @PPSCG.operation(
     directives={"ngpu": 0, "executable": "python -u"},
@@ -314,7 +349,7 @@ def production_run(job):
 )
 def sample(job):
     import numpy as np
-    from cmeutils.dynamics import msd_from_gsd
+    from utils.dynamics import sample_msd
     with job:
         print("------------------------------------")
         print("JOB ID NUMBER:")
@@ -333,26 +368,18 @@ def sample(job):
         ) 
         ts = job.doc.real_time_step * 1e-15
         ts_frame = steps_per_frame * ts
-
-        count = 0
-        for i in job.doc.msd_start_indices:
-            msd = msd_from_gsd(
-                    gsdfile=job.fn("production.gsd"),
-                    start=int(i),
-                    stop=int(i) + job.doc.msd_chunk_size,
-                    atom_types="all",
-                    msd_mode="direct"
-            )
-            msd_results = np.copy(msd.msd)
-            conv_factor = (job.doc.ref_length**2) * 1e-18 
-            job.doc.msd_units = "nm**2 / s"
-            msd_results *= conv_factor 
-            time_array = np.arange(0, job.doc.msd_chunk_size, 1) * ts_frame
-            np.save(file=job.fn(f"msd_time{count}.npy"), arr=time_array) 
-            np.save(file=job.fn(f"msd_data_real{count}.npy"), arr=msd_results)
-            np.save(file=job.fn(f"msd_data_raw{count}.npy"), arr=msd.msd)
-            print(f"MSD calculation number {count} using window {i} finished and saved...")
-            count += 1
+        conv_factor = (job.doc.ref_length**2) * 1e-18
+        job.doc.msd_units = "nm**2 / s"
+        # Unwrap production.gsd once and compute every window from it
+        sample_msd(
+                gsdfile=job.fn("production.gsd"),
+                starts=job.doc.msd_start_indices,
+                window=job.doc.msd_chunk_size,
+                frame_time=ts_frame,
+                conv_factor=conv_factor,
+                fpath=job.fn("msd.npz"),
+        )
+        print(f"{job.doc.msd_n_samples} MSD windows finished and saved...")
 
         print("Finished.")
         job.doc.sampled = True
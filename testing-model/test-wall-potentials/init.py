@@ -54,6 +54,9 @@ def main():
         job.init()
         job.doc.setdefault("equilibrated", False)
         job.doc.setdefault("sampled", False)
+        # Convert production.gsd to a memory mapped store of unwrapped
+        # positions before sampling (the unwrap operation)
+        job.doc.setdefault("unwrap_production", False)
         job.doc.setdefault("runs", 0)
 
 
@@ -199,54 +199,44 @@ def sample(job):
     import numpy as np
     import unyt
     from unyt import Unit
-    from cmeutils.polymers import (
-            radius_of_gyration,
-            end_to_end_distance,
-            persistence_length
-    )
+    from utils.polymers import chain_statistics
     with job:
         print("------------------------------------")
         print("JOB ID NUMBER:")
         print(job.id)
         print("------------------------------------")
-        print("Sampling Radius of Gyration...")
+        print("Sampling Rg, Re and Persistence Length...")
         print("------------------------------------")
-        gsd_path = job.fn("target_1monomer_per_bead.gsd")
-        rg_means, rg_std, rg_array = radius_of_gyration(
-                gsd_file=gsd_path,
+        stats = chain_statistics(
+                gsd_file=job.fn("target_1monomer_per_bead.gsd"),
                 start=job.doc.equil_gsd_start,
                 stop=-1,
                 stride=job.doc.equil_gsd_stride,
+                head_index=0,
+                tail_index=-1,
+                window_size=25,
+                backbone_types=["A"],
         )
+        rg_means = np.mean(stats["rg"], axis=1)
         job.doc.rg_avg = np.mean(rg_means)
         job.doc.rg_std = np.std(rg_means)
-        np.save(arr=np.array(rg_array), file=job.fn("rg_samples.npy"))
-        print("------------------------------------")
-        print("Sampling End-to-End Distance...")
-        print("------------------------------------")
-        re_means, re_std, re_array, re_vectors = end_to_end_distance(
+        np.save(arr=stats["rg"], file=job.fn("rg_samples.npy"))
+        # The end-to-end distance is measured on the atomistic chain
+        re = chain_statistics(
                 gsd_file=job.fn(f"trajectory{job.doc.runs - 1}.gsd"),
                 start=job.doc.equil_gsd_start,
                 stop=-1,
                 stride=job.doc.equil_gsd_stride,
                 head_index=0,
                 tail_index=-1,
-        )
+                window_size=None,
+        )["re"]
+        re_means = np.mean(re, axis=1)
         job.doc.re_avg = np.mean(re_means)
         job.doc.re_std = np.std(re_means)
-        np.save(arr=np.array(re_array), file=job.fn("re_samples.npy"))
-        print("------------------------------------")
-        print("Sampling Persistence Length...")
-        print("------------------------------------")
-        lp_mean, lp_std = persistence_length(
-                gsd_file=job.fn(f"trajectory{job.doc.runs - 1}.gsd"),
-                select_atoms_arg = "name A A",
-                start=job.doc.equil_gsd_start,
-                window_size=25,
-                stop=-1
-        )
-        job.doc.lp_mean = lp_mean
-        job.doc.lp_std = lp_std
+        np.save(arr=re, file=job.fn("re_samples.npy"))
+        job.doc.lp_mean = np.mean(stats["lp"])
+        job.doc.lp_std = np.std(stats["lp"])
 
         print("Finished.")
         job.doc.sampled = True
@@ -1 +1,16 @@
-from .utils import check_npt_equilibration, check_nvt_equilibration
\ No newline at end of file
+from .dynamics import load_msd, msd_fft, sample_msd, window_msds
+from .logs import LogCache, LogTail, log_column, tail_writer
+from .polymers import chain_statistics
+from .rdf import RDFSpec, batch_rdfs, job_rdfs, rdfs
+from .sampling import equil_sample, is_equilibrated, statistical_inefficiency
+from .trajectory import (
+    MultiTrajectory,
+    UnwrappedTrajectory,
+    job_trajectory,
+    write_unwrapped
+)
+from .utils import (
+    EquilibrationMonitor,
+    check_npt_equilibration,
+    check_nvt_equilibration
+)
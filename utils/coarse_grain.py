@@ -0,0 +1,355 @@
+import contextlib
+import hashlib
+import json
+import os
+
+import gsd.hoomd
+import numpy as np
+
+
+def bead_mapping_from_grits(cg_system):
+    """Get bead type: list of atom index arrays from a grits CG_System."""
+    mapping = dict()
+    for key, indices in cg_system.mapping.items():
+        # grits keys look like _A...c1ccc(S)cc1
+        bead_type = key.split("...")[0].lstrip("_")
+        mapping.setdefault(bead_type, []).extend(
+                [np.asarray(inds, dtype=np.int64) for inds in indices]
+        )
+    return mapping
+
+
+def topology_hash(frame):
+    """Hash of the particle types and bonds of a gsd.hoomd.Frame."""
+    h = hashlib.sha1()
+    h.update(str(frame.particles.N).encode())
+    h.update(json.dumps(list(frame.particles.types)).encode())
+    h.update(np.ascontiguousarray(frame.particles.typeid, np.uint32).tobytes())
+    h.update(np.ascontiguousarray(frame.bonds.group, np.uint32).tobytes())
+    return h.hexdigest()
+
+
+def _save_mapping(fpath, mapping):
+    arrays = dict()
+    for bead_type, beads in mapping.items():
+        arrays[f"{bead_type}_atoms"] = np.concatenate(beads)
+        arrays[f"{bead_type}_offsets"] = np.cumsum(
+                [0] + [len(bead) for bead in beads]
+        )
+    tmp_path = fpath + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, fpath)
+
+
+def _load_mapping(fpath):
+    mapping = dict()
+    with np.load(fpath) as data:
+        for key in data.files:
+            if not key.endswith("_atoms"):
+                continue
+            bead_type = key[:-len("_atoms")]
+            atoms = data[key]
+            offsets = data[f"{bead_type}_offsets"]
+            mapping[bead_type] = np.split(atoms, offsets[1:-1])
+    return mapping
+
+
+def cached_bead_mapping(gsdfile, beads, cache_dir, **grits_kwargs):
+    """Bead type: list of atom index arrays for a GSD file, with caching.
+
+    The SMARTS matching done by grits.CG_System is only run the first time
+    a topology is seen. The resulting bead to atom indices are saved in
+    cache_dir under a key made from the hash of the topology in the first
+    frame of gsdfile, the bead SMARTS and add_hydrogens, so any later
+    trajectory of the same system skips the matching.
+
+    Parameters
+    ----------
+    gsdfile : str
+        Atomistic GSD file, only the first frame is used
+    beads : dict
+        Bead type: SMARTS string, passed to grits.CG_System
+    cache_dir : str
+        Directory to store the mapping files in
+    grits_kwargs
+        Passed on to grits.CG_System (conversion_dict, add_hydrogens, ...)
+    """
+    with gsd.hoomd.open(gsdfile, "r") as traj:
+        top_hash = topology_hash(traj[0])
+    key_data = json.dumps(
+            {
+                "topology": top_hash,
+                "beads": beads,
+                "add_hydrogens": bool(grits_kwargs.get("add_hydrogens"))
+            },
+            sort_keys=True
+    )
+    key = hashlib.sha1(key_data.encode()).hexdigest()
+    fpath = os.path.join(cache_dir, f"{key}.npz")
+    if os.path.isfile(fpath):
+        return _load_mapping(fpath)
+
+    from grits import CG_System
+
+    cg_system = CG_System(gsdfile=gsdfile, beads=beads, **grits_kwargs)
+    mapping = bead_mapping_from_grits(cg_system)
+    os.makedirs(cache_dir, exist_ok=True)
+    _save_mapping(fpath, mapping)
+    return mapping
+
+
+def _box_matrices(boxes):
+    """(n_frames, 3, 3) box matrices from (n_frames, 6) GSD boxes."""
+    boxes = np.atleast_2d(boxes)
+    Lx, Ly, Lz, xy, xz, yz = boxes.T
+    H = np.zeros((len(boxes), 3, 3))
+    H[:, 0, 0] = Lx
+    H[:, 0, 1] = xy * Ly
+    H[:, 0, 2] = xz * Lz
+    H[:, 1, 1] = Ly
+    H[:, 1, 2] = yz * Lz
+    H[:, 2, 2] = Lz
+    return H
+
+
+def _unwrap(positions, images, boxes):
+    """Unwrap (n_frames, N, 3) positions using their images."""
+    return positions + np.einsum("fnj,fij->fni", images, _box_matrices(boxes))
+
+
+def _wrap(positions, boxes):
+    """Wrap (n_frames, N, 3) positions into the box.
+
+    Returns the wrapped positions and their images.
+    """
+    H = _box_matrices(boxes)
+    frac = np.einsum("fnj,fij->fni", positions, np.linalg.inv(H)) + 0.5
+    images = np.floor(frac)
+    wrapped = positions - np.einsum("fnj,fij->fni", images, H)
+    return wrapped, images.astype(np.int32)
+
+
+def _topology_name(types):
+    if types[-1] < types[0]:
+        types = types[::-1]
+    return "-".join(types)
+
+
+class CGTopology:
+    """Bead membership, types and bonded topology of a coarse-grained system.
+
+    Parameters
+    ----------
+    mapping : dict
+        Bead type: list of atom index arrays, one array per bead
+    atom_bonds : np.ndarray, shape (n_bonds, 2)
+        Bond groups of the atomistic system, used to find bonds between beads
+    """
+    def __init__(self, mapping, atom_bonds):
+        self.types = sorted(mapping)
+        self.bead_atoms = []
+        typeid = []
+        for type_id, bead_type in enumerate(self.types):
+            self.bead_atoms.extend(mapping[bead_type])
+            typeid.extend([type_id] * len(mapping[bead_type]))
+        self.typeid = np.array(typeid, dtype=np.uint32)
+        self.N = len(self.bead_atoms)
+        # Atom indices sorted by bead and where each bead starts, for
+        # np.add.reduceat over the atoms of every bead at once
+        self.atom_order = np.concatenate(self.bead_atoms).astype(np.int64)
+        self.bead_starts = np.cumsum(
+                [0] + [len(atoms) for atoms in self.bead_atoms[:-1]]
+        )
+        self.atom_to_bead = dict()
+        for bead, atoms in enumerate(self.bead_atoms):
+            for atom in atoms:
+                self.atom_to_bead[int(atom)] = bead
+        self._build_bonded(np.asarray(atom_bonds))
+
+    def _build_bonded(self, atom_bonds):
+        bonds = set()
+        for a, b in atom_bonds:
+            i = self.atom_to_bead.get(int(a))
+            j = self.atom_to_bead.get(int(b))
+            if i is None or j is None or i == j:
+                continue
+            bonds.add((min(i, j), max(i, j)))
+        self.bonds = np.array(sorted(bonds), dtype=np.uint32).reshape(-1, 2)
+
+        neighbors = [[] for _ in range(self.N)]
+        for i, j in self.bonds:
+            neighbors[i].append(int(j))
+            neighbors[j].append(int(i))
+        angles = []
+        for j in range(self.N):
+            for a, i in enumerate(neighbors[j]):
+                for k in neighbors[j][a + 1:]:
+                    angles.append((i, j, k))
+        dihedrals = []
+        for j, k in self.bonds:
+            for i in neighbors[j]:
+                if i == k:
+                    continue
+                for l in neighbors[k]:
+                    if l in (i, j):
+                        continue
+                    dihedrals.append((i, j, k, l))
+        self.angles = np.array(angles, dtype=np.uint32).reshape(-1, 3)
+        self.dihedrals = np.array(dihedrals, dtype=np.uint32).reshape(-1, 4)
+        # Type names and typeids of every bonded group, the same in every
+        # frame, so empty_frame only has to assign them
+        self._bonded = [
+            (attr, groups) + self._groups(groups)
+            for attr, groups in [
+                ("bonds", self.bonds),
+                ("angles", self.angles),
+                ("dihedrals", self.dihedrals)
+            ]
+        ]
+
+    def _groups(self, groups):
+        names = [
+            _topology_name([self.types[self.typeid[i]] for i in group])
+            for group in groups
+        ]
+        group_types = sorted(set(names))
+        typeid = np.array(
+                [group_types.index(name) for name in names], dtype=np.uint32
+        )
+        return group_types, typeid
+
+    def empty_frame(self):
+        """A gsd.hoomd.Frame with the CG particle and bonded topology set."""
+        frame = gsd.hoomd.Frame()
+        frame.particles.N = self.N
+        frame.particles.types = self.types
+        frame.particles.typeid = self.typeid
+        for attr, groups, group_types, typeid in self._bonded:
+            data = getattr(frame, attr)
+            data.N = len(groups)
+            data.types = list(group_types)
+            data.typeid = typeid
+            data.group = groups
+        return frame
+
+
+def coarse_grain_positions(positions, images, boxes, masses, topology):
+    """Bead centers of mass for a block of frames.
+
+    Parameters
+    ----------
+    positions : np.ndarray, shape (n_frames, n_atoms, 3)
+    images : np.ndarray, shape (n_frames, n_atoms, 3)
+    boxes : np.ndarray, shape (n_frames, 6)
+    masses : np.ndarray, shape (n_atoms,)
+    topology : CGTopology
+
+    Returns
+    -------
+    bead_positions : np.ndarray, shape (n_frames, n_beads, 3)
+        Wrapped into the box of each frame
+    bead_images : np.ndarray, shape (n_frames, n_beads, 3)
+    bead_masses : np.ndarray, shape (n_beads,)
+    """
+    unwrapped = _unwrap(positions, images, boxes)
+    weights = masses[topology.atom_order]
+    bead_masses = np.add.reduceat(weights, topology.bead_starts)
+    weighted = unwrapped[:, topology.atom_order] * weights[None, :, None]
+    com = np.add.reduceat(weighted, topology.bead_starts, axis=1)
+    com /= bead_masses[None, :, None]
+    bead_positions, bead_images = _wrap(com, boxes)
+    return bead_positions, bead_images, bead_masses
+
+
+def _read_block(traj, indices, n_atoms):
+    positions = np.empty((len(indices), n_atoms, 3))
+    images = np.zeros((len(indices), n_atoms, 3))
+    boxes = np.empty((len(indices), 6))
+    steps = np.empty(len(indices), dtype=np.uint64)
+    for i, idx in enumerate(indices):
+        positions[i] = traj.read_chunk(idx, "particles/position")
+        image = traj.read_chunk(idx, "particles/image")
+        if image is not None:
+            images[i] = image
+        boxes[i] = traj.read_chunk(idx, "configuration/box")
+        step = traj.read_chunk(idx, "configuration/step")
+        steps[i] = 0 if step is None else step[0]
+    return positions, images, boxes, steps
+
+
+def coarse_grain_trajectory(
+        traj,
+        mapping,
+        cg_gsdfile,
+        length_scale=1.0,
+        mass_scale=1.0,
+        start=0,
+        stop=None,
+        stride=1,
+        block_size=100
+):
+    """Write a coarse-grained GSD file from an atomistic trajectory.
+
+    Frames are read in blocks of block_size into contiguous
+    (n_frames, n_atoms, 3) arrays straight from the GSD chunks, and the bead
+    centers of mass of the whole block are computed with one np.add.reduceat.
+
+    Parameters
+    ----------
+    traj : str or utils.MultiTrajectory
+        Path to, or view of, the atomistic trajectory to map
+    mapping : dict
+        Bead type: list of atom index arrays, one array per bead
+    cg_gsdfile : str
+        Path to the coarse-grained GSD file to write
+    length_scale : float, default 1.0
+        Factor to multiply positions and box lengths by
+    mass_scale : float, default 1.0
+        Factor to multiply bead masses by
+    start, stop, stride : int
+        Frames of traj to map
+    block_size : int, default 100
+        Number of frames to read and map at once
+    """
+    from .trajectory import MultiTrajectory
+
+    # Only close traj if it was opened here
+    if isinstance(traj, MultiTrajectory):
+        context = contextlib.nullcontext(traj)
+    else:
+        context = MultiTrajectory([traj])
+    with context as traj:
+        first_frame = traj[0]
+        topology = CGTopology(mapping, first_frame.bonds.group)
+        masses = np.asarray(first_frame.particles.mass, dtype=np.float64)
+        n_atoms = first_frame.particles.N
+        frames = traj[start:stop:stride]
+        with gsd.hoomd.open(cg_gsdfile, "w") as cg_traj:
+            for block_start in range(0, len(frames), block_size):
+                block_stop = min(block_start + block_size, len(frames))
+                indices = range(block_start, block_stop)
+                positions, images, boxes, steps = _read_block(
+                        frames, indices, n_atoms
+                )
+                bead_positions, bead_images, bead_masses = (
+                        coarse_grain_positions(
+                            positions, images, boxes, masses, topology
+                        )
+                )
+                cg_boxes = boxes.copy()
+                cg_boxes[:, :3] *= length_scale
+                bead_positions *= length_scale
+                bead_masses = (bead_masses * mass_scale).astype(np.float32)
+                cg_frames = []
+                for i in range(len(indices)):
+                    cg_frame = topology.empty_frame()
+                    cg_frame.configuration.step = steps[i]
+                    cg_frame.configuration.box = cg_boxes[i]
+                    cg_frame.particles.position = bead_positions[i].astype(
+                            np.float32
+                    )
+                    cg_frame.particles.image = bead_images[i]
+                    cg_frame.particles.mass = bead_masses
+                    cg_frames.append(cg_frame)
+                cg_traj.extend(cg_frames)
+    return topology
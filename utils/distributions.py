@@ -0,0 +1,315 @@
+"""Pair, bond, angle and dihedral distributions accumulated frame by frame.
+
+The accumulators take anything laid out like a gsd.hoomd.Frame, which
+includes a hoomd.Snapshot, so the same code can sample a running HOOMD
+simulation (see accumulator_writer) or frames read from a GSD file.
+Distributions are binned on a fixed grid of bin centers, e.g. the x values
+of an MSIBI target distribution, and returned as (n_bins, 2) arrays of
+x, y like the ones msibi computes from trajectories.
+"""
+import numpy as np
+
+from .coarse_grain import _box_matrices, topology_hash
+
+
+def _bin_edges(bin_centers):
+    centers = np.asarray(bin_centers, dtype=np.float64)
+    mids = (centers[1:] + centers[:-1]) / 2
+    return np.concatenate([
+        [centers[0] - (mids[0] - centers[0])],
+        mids,
+        [centers[-1] + (centers[-1] - mids[-1])]
+    ])
+
+
+def _minimum_image(vectors, box):
+    """Apply the minimum image convention to (n, 3) vectors in a GSD box."""
+    H = _box_matrices(box)[0]
+    frac = vectors @ np.linalg.inv(H).T
+    frac -= np.round(frac)
+    return frac @ H.T
+
+
+def molecule_ids(n_particles, bonds):
+    """Index of the molecule, i.e. bond-connected cluster, of every particle."""
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+    graph = coo_matrix(
+            (np.ones(len(bonds)), (bonds[:, 0], bonds[:, 1])),
+            shape=(n_particles, n_particles)
+    )
+    return connected_components(graph, directed=False)[1]
+
+
+class BondedExclusions:
+    """Particle pairs to drop from neighbor lists, built once from the bonds.
+
+    Parameters
+    ----------
+    n_particles : int
+    bonds : np.ndarray, shape (n_bonds, 2)
+    max_bonds : int, optional
+        Exclude pairs at most max_bonds bonds apart. By default every pair
+        in the same molecule is excluded.
+
+    The pairs within max_bonds are stored as sorted i * N + j keys, so
+    excluded() is a vectorized binary search over a whole neighbor list.
+    """
+    def __init__(self, n_particles, bonds, max_bonds=None):
+        self.n_particles = n_particles
+        self.max_bonds = max_bonds
+        self.molecules = molecule_ids(n_particles, bonds)
+        self._keys = None
+        if max_bonds is not None:
+            self._keys = self._pair_keys(n_particles, bonds, max_bonds)
+
+    @staticmethod
+    def _pair_keys(n_particles, bonds, max_bonds):
+        from scipy.sparse import coo_matrix, identity
+
+        bonds = np.asarray(bonds, dtype=np.int64).reshape(-1, 2)
+        ones = np.ones(len(bonds))
+        adjacency = coo_matrix(
+                (
+                    np.concatenate([ones, ones]),
+                    (
+                        np.concatenate([bonds[:, 0], bonds[:, 1]]),
+                        np.concatenate([bonds[:, 1], bonds[:, 0]])
+                    )
+                ),
+                shape=(n_particles, n_particles)
+        ).tocsr()
+        step = identity(n_particles, format="csr") + adjacency
+        reach = identity(n_particles, format="csr")
+        for _ in range(max_bonds):
+            reach = reach @ step
+            reach.data[:] = 1
+        reach = reach.tocoo()
+        return np.unique(
+                reach.row.astype(np.int64) * n_particles + reach.col
+        )
+
+    def excluded(self, i, j):
+        """Boolean mask of the pairs (i[n], j[n]) to exclude."""
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        same = self.molecules[i] == self.molecules[j]
+        if self._keys is None:
+            return same
+        # Only pairs within a molecule can be bonded, search just those
+        keys = i[same] * self.n_particles + j[same]
+        idx = np.searchsorted(self._keys, keys)
+        idx[idx == len(self._keys)] = 0
+        same[same] = self._keys[idx] == keys
+        return same
+
+
+_exclusions = dict()
+
+
+def bonded_exclusions(frame, max_bonds=None):
+    """BondedExclusions of a frame's topology, built once per topology and
+    max_bonds and reused for every later frame or trajectory with the same
+    particles and bonds."""
+    key = (topology_hash(frame), max_bonds)
+    if key not in _exclusions:
+        _exclusions[key] = BondedExclusions(
+                frame.particles.N, frame.bonds.group, max_bonds=max_bonds
+        )
+    return _exclusions[key]
+
+
+def bond_lengths(positions, box, groups):
+    d = _minimum_image(positions[groups[:, 1]] - positions[groups[:, 0]], box)
+    return np.linalg.norm(d, axis=1)
+
+
+def bond_angles(positions, box, groups):
+    """Angles i-j-k in radians."""
+    u = _minimum_image(positions[groups[:, 0]] - positions[groups[:, 1]], box)
+    v = _minimum_image(positions[groups[:, 2]] - positions[groups[:, 1]], box)
+    cos = np.einsum("ij,ij->i", u, v) / (
+            np.linalg.norm(u, axis=1) * np.linalg.norm(v, axis=1)
+    )
+    return np.arccos(np.clip(cos, -1.0, 1.0))
+
+
+def dihedral_angles(positions, box, groups):
+    """Dihedral angles i-j-k-l in radians, between -pi and pi."""
+    b1 = _minimum_image(positions[groups[:, 1]] - positions[groups[:, 0]], box)
+    b2 = _minimum_image(positions[groups[:, 2]] - positions[groups[:, 1]], box)
+    b3 = _minimum_image(positions[groups[:, 3]] - positions[groups[:, 2]], box)
+    n1 = np.cross(b1, b2)
+    n2 = np.cross(b2, b3)
+    m1 = np.cross(n1, b2 / np.linalg.norm(b2, axis=1)[:, None])
+    x = np.einsum("ij,ij->i", n1, n2)
+    y = np.einsum("ij,ij->i", m1, n2)
+    return np.arctan2(y, x)
+
+
+class BondedAccumulator:
+    """Running histogram of one bond, angle or dihedral type.
+
+    Parameters
+    ----------
+    kind : str
+        One of "bonds", "angles" or "dihedrals"
+    name : str
+        Bond, angle or dihedral type name, e.g. "A-A-A"
+    bin_centers : np.ndarray
+    """
+    _measures = {
+        "bonds": bond_lengths,
+        "angles": bond_angles,
+        "dihedrals": dihedral_angles,
+    }
+
+    def __init__(self, kind, name, bin_centers):
+        self.kind = kind
+        self.name = name
+        self.bin_centers = np.asarray(bin_centers, dtype=np.float64)
+        self.bin_edges = _bin_edges(self.bin_centers)
+        self.counts = np.zeros(len(self.bin_centers))
+        self.n_frames = 0
+        self._groups = None
+
+    def _select_groups(self, frame):
+        data = getattr(frame, self.kind)
+        names = list(data.types)
+        # Accept the type name written either way around, e.g. A-B or B-A
+        reverse = "-".join(self.name.split("-")[::-1])
+        ids = [names.index(n) for n in {self.name, reverse} if n in names]
+        mask = np.isin(np.asarray(data.typeid), ids)
+        return np.asarray(data.group, dtype=np.int64)[mask]
+
+    def update(self, frame):
+        if self._groups is None:
+            self._groups = self._select_groups(frame)
+        values = self._measures[self.kind](
+                np.asarray(frame.particles.position, dtype=np.float64),
+                np.asarray(frame.configuration.box, dtype=np.float64),
+                self._groups
+        )
+        self.counts += np.histogram(values, bins=self.bin_edges)[0]
+        self.n_frames += 1
+
+    def distribution(self):
+        """(n_bins, 2) array of bin centers and the normalized histogram."""
+        dx = np.diff(self.bin_edges)
+        total = np.sum(self.counts)
+        y = self.counts / (total * dx) if total > 0 else self.counts.copy()
+        return np.column_stack([self.bin_centers, y])
+
+
+class PairAccumulator:
+    """Running radial distribution function between two particle types.
+
+    Uses freud.density.RDF with reset=False. With exclude_bonded, pairs in
+    the same molecule, or only those at most max_bonds bonds apart, are
+    dropped from the neighbor list and the RDF is rescaled by the fraction
+    of pairs kept, like cmeutils.structure.gsd_rdf does.
+
+    Parameters
+    ----------
+    type1, type2 : str
+        Particle types
+    bin_centers : np.ndarray
+    exclude_bonded : bool, default True
+    max_bonds : int, optional
+        See BondedExclusions
+    """
+    def __init__(
+            self,
+            type1,
+            type2,
+            bin_centers,
+            exclude_bonded=True,
+            max_bonds=None
+    ):
+        import freud
+
+        self.type1 = type1
+        self.type2 = type2
+        self.exclude_bonded = exclude_bonded
+        self.max_bonds = max_bonds
+        self.bin_centers = np.asarray(bin_centers, dtype=np.float64)
+        edges = _bin_edges(self.bin_centers)
+        self.r_min = max(edges[0], 0.0)
+        self.r_max = edges[-1]
+        self.rdf = freud.density.RDF(
+                bins=len(self.bin_centers), r_max=self.r_max, r_min=self.r_min
+        )
+        self.n_frames = 0
+        self._n_pairs = 0
+        self._n_kept = 0
+        self._topology = None
+
+    def _select(self, frame):
+        types = list(frame.particles.types)
+        typeid = np.asarray(frame.particles.typeid)
+        A = np.nonzero(typeid == types.index(self.type1))[0]
+        B = np.nonzero(typeid == types.index(self.type2))[0]
+        exclusions = None
+        if self.exclude_bonded:
+            exclusions = bonded_exclusions(frame, max_bonds=self.max_bonds)
+        return A, B, exclusions
+
+    def update(self, frame):
+        import freud
+
+        if self._topology is None:
+            self._topology = self._select(frame)
+        A, B, exclusions = self._topology
+        box = freud.box.Box(*frame.configuration.box)
+        positions = np.asarray(frame.particles.position, dtype=np.float32)
+        aq = freud.locality.AABBQuery(box, positions[A])
+        nlist = aq.query(
+                positions[B],
+                {"r_max": self.r_max, "exclude_ii": self.type1 == self.type2}
+        ).toNeighborList()
+        if exclusions is not None:
+            self._n_pairs += len(nlist)
+            nlist.filter(~exclusions.excluded(
+                    A[nlist.point_indices], B[nlist.query_point_indices]
+            ))
+            self._n_kept += len(nlist)
+        self.rdf.compute(
+                aq, query_points=positions[B], neighbors=nlist, reset=False
+        )
+        self.n_frames += 1
+
+    def distribution(self):
+        """(n_bins, 2) array of bin centers and g(r)."""
+        rdf = np.array(self.rdf.rdf, dtype=np.float64)
+        if self._n_pairs > 0:
+            rdf *= self._n_kept / self._n_pairs
+        return np.column_stack([self.bin_centers, rdf])
+
+
+def accumulator_writer(accumulators, trigger):
+    """Create a HOOMD writer that passes snapshots to accumulators.
+
+    Parameters
+    ----------
+    accumulators : list
+        Objects with an update(frame) method, e.g. PairAccumulator
+    trigger : hoomd.trigger.Trigger or int
+        When to sample, an int is used as a periodic trigger
+    """
+    import hoomd
+
+    class _AccumulateAction(hoomd.custom.Action):
+        def act(self, timestep):
+            snapshot = self._state.get_snapshot()
+            if snapshot.communicator.rank != 0:
+                return
+            for accumulator in accumulators:
+                accumulator.update(snapshot)
+
+    if isinstance(trigger, int):
+        trigger = hoomd.trigger.Periodic(trigger)
+    return hoomd.write.CustomWriter(
+            action=_AccumulateAction(), trigger=trigger
+    )
@@ -0,0 +1,153 @@
+"""Mean squared displacements of many windows from a single trajectory read.
+
+cmeutils.dynamics.msd_from_gsd opens and decodes the GSD file again for
+every window. Here the unwrapped positions are read once into a memory
+mapped UnwrappedTrajectory store, see utils.trajectory.write_unwrapped, and
+every window is a zero copy slice of it. If the trajectory was already
+converted, nothing is decoded at all. The MSD of a window is the multiple
+time origin average computed with FFTs (O(T log T) per window), which gives
+the same result as freud's "direct" mode.
+"""
+import os
+import tempfile
+
+import numpy as np
+
+from .trajectory import UnwrappedTrajectory, write_unwrapped
+
+
+def msd_fft(positions, particle_chunk=2048):
+    """Multiple time origin MSD, averaged over particles, for every lag.
+
+    Parameters
+    ----------
+    positions : np.ndarray, shape (n_frames, n_particles, 3)
+        Unwrapped positions, e.g. a slice of UnwrappedTrajectory.positions
+    particle_chunk : int, default 2048
+        Particles transformed at once, bounds the memory used
+
+    Returns
+    -------
+    np.ndarray, shape (n_frames,)
+        MSD(m) = < |r(t + m) - r(t)|^2 >, averaged over particles and all
+        time origins t
+    """
+    n_frames, n_particles = positions.shape[:2]
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_frames)))
+    n_origins = n_frames - np.arange(n_frames)
+    msd = np.zeros(n_frames)
+    for start in range(0, n_particles, particle_chunk):
+        r = np.asarray(
+                positions[:, start:start + particle_chunk], dtype=np.float64
+        ).reshape(n_frames, -1)
+        # S1(m) = sum over origins of r^2(t) + r^2(t + m)
+        d = np.einsum("ij,ij->i", r, r)
+        head = np.concatenate([[0.0], np.cumsum(d)[:-1]])
+        tail = np.concatenate([[0.0], np.cumsum(d[::-1])[:-1]])
+        S1 = 2 * d.sum() - head - tail
+        # S2(m) = sum over origins of r(t) . r(t + m), by FFT
+        f = np.fft.rfft(r, n=n_fft, axis=0)
+        power = np.sum(f.real ** 2 + f.imag ** 2, axis=1)
+        S2 = np.fft.irfft(power, n=n_fft)[:n_frames]
+        msd += (S1 - 2 * S2) / n_origins
+    return msd / n_particles
+
+
+def window_msds(positions, starts, window):
+    """msd_fft of every window positions[start:start + window].
+
+    Returns an (n_windows, window) array.
+    """
+    return np.stack([
+        msd_fft(positions[int(start):int(start) + window]) for start in starts
+    ])
+
+
+def sample_msd(
+        gsdfile,
+        starts,
+        window,
+        frame_time=1.0,
+        conv_factor=1.0,
+        fpath="msd.npz",
+        full=False
+):
+    """Compute the MSD of every window and save them to one .npz file.
+
+    Parameters
+    ----------
+    gsdfile : str
+        Trajectory to sample, e.g. production.gsd
+    starts : array-like of int
+        First frame of every window
+    window : int
+        Frames per window
+    frame_time : float, default 1.0
+        Time between frames, the "time" array is in these units
+    conv_factor : float, default 1.0
+        Multiplies the MSDs in simulation units to give "msd_real"
+    fpath : str, default "msd.npz"
+    full : bool, default False
+        Also store the MSD of the whole trajectory as "full_msd_raw" and
+        "full_msd_real"
+
+    The file holds "time", "starts", "msd_raw" and "msd_real", each MSD
+    array with one row per window. Without an up to date store of gsdfile
+    the needed frames are unwrapped to a temporary one.
+    """
+    starts = np.asarray(starts, dtype=np.int64)
+    store = UnwrappedTrajectory.for_gsd(gsdfile)
+    if store is not None:
+        return _sample_msd(
+                store.positions, starts, window, frame_time, conv_factor,
+                fpath, full
+        )
+    stop = None if full else int(starts.max()) + window
+    with tempfile.TemporaryDirectory(
+            dir=os.path.dirname(os.path.abspath(fpath))
+    ) as tmp:
+        store = write_unwrapped(
+                gsdfile, prefix=os.path.join(tmp, "unwrapped"), stop=stop
+        )
+        results = _sample_msd(
+                store.positions, starts, window, frame_time, conv_factor,
+                fpath, full
+        )
+        del store
+    return results
+
+
+def _sample_msd(
+        positions, starts, window, frame_time, conv_factor, fpath, full
+):
+    msd_raw = window_msds(positions, starts, window)
+    results = dict(
+            time=np.arange(window) * frame_time,
+            starts=starts,
+            msd_raw=msd_raw,
+            msd_real=msd_raw * conv_factor
+    )
+    if full:
+        full_msd = msd_fft(positions)
+        results["full_time"] = np.arange(len(full_msd)) * frame_time
+        results["full_msd_raw"] = full_msd
+        results["full_msd_real"] = full_msd * conv_factor
+    np.savez(fpath, **results)
+    return results
+
+
+def load_msd(job):
+    """time, msd_real arrays of a sampled job, each MSD row one window.
+
+    Reads msd.npz, or the msd_time{i}.npy and msd_data_real{i}.npy files
+    written per window by older sample operations.
+    """
+    if job.isfile("msd.npz"):
+        data = np.load(job.fn("msd.npz"))
+        return data["time"], data["msd_real"]
+    time = np.load(job.fn("msd_time0.npy"))
+    msd = np.stack([
+        np.load(job.fn(f"msd_data_real{i}.npy"))
+        for i in range(job.doc.msd_n_samples)
+    ])
+    return time, msd
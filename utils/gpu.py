@@ -0,0 +1,259 @@
+"""GPU utilization tracking for packing several operations onto one GPU.
+
+The small CG systems optimized with MSIBI leave most of a GPU idle. The
+MSIBI projects install GPUMonitorHooks, which record the mean utilization
+and peak memory of the GPU while each optimize operation runs. Running
+
+    $ python -m utils.gpu path/to/project
+
+then prints how many such jobs fit on one GPU, which is the value to pass
+to `submit --bundle N --parallel --jobs-per-gpu N`. With --jobs-per-gpu
+the Fry and Borah templates request one GPU per N bundled operations, give
+every N consecutive operations of the bundle their own GPU, and start the
+CUDA MPS daemon so the operations share them.
+"""
+import contextlib
+import os
+import subprocess
+import threading
+
+import numpy as np
+
+
+def query_gpus(device=None):
+    """Utilization (%), memory used and total memory (MiB) of every GPU
+    nvidia-smi can see, or only of `device` (an index or UUID), as an
+    (n_gpus, 3) array."""
+    command = [
+        "nvidia-smi",
+        "--query-gpu=utilization.gpu,memory.used,memory.total",
+        "--format=csv,noheader,nounits"
+    ]
+    if device is not None:
+        command.append(f"--id={device}")
+    output = subprocess.run(
+            command,
+            capture_output=True,
+            text=True,
+            check=True
+    ).stdout
+    rows = [line.split(",") for line in output.strip().splitlines()]
+    return np.array(rows, dtype=np.float64).reshape(-1, 3)
+
+
+def gpu_uuids(devices=None):
+    """UUIDs of `devices`, a comma separated list of nvidia-smi indices or
+    UUIDs, or of every GPU, in nvidia-smi order."""
+    command = ["nvidia-smi", "--query-gpu=uuid", "--format=csv,noheader"]
+    if devices:
+        command.append(f"--id={devices}")
+    output = subprocess.run(
+            command, capture_output=True, text=True, check=True
+    ).stdout
+    return [line.strip() for line in output.strip().splitlines()]
+
+
+def visible_device():
+    """The GPU this process runs on, the first entry of
+    CUDA_VISIBLE_DEVICES, as something nvidia-smi --id accepts, or None if
+    it isn't set.
+
+    nvidia-smi ignores CUDA_VISIBLE_DEVICES and numbers GPUs physically. On
+    shared GPUs the Fry and Borah templates number the GPUs of the
+    allocation from 0 and keep the allocation's own CUDA_VISIBLE_DEVICES
+    in ALLOCATED_GPUS, so such an index is mapped to the UUID of the
+    allocated GPU.
+    """
+    device = os.environ.get("CUDA_VISIBLE_DEVICES", "").split(",")[0]
+    device = device.strip()
+    if not device:
+        return None
+    allocated = os.environ.get("ALLOCATED_GPUS")
+    if allocated and device.isdigit():
+        return gpu_uuids(allocated)[int(device)]
+    return device
+
+
+# GPUMonitors with a running sampling thread
+_running = set()
+
+
+@contextlib.contextmanager
+def monitors_paused():
+    """Stop the thread of every running GPUMonitor and restart it on exit,
+    e.g. so a process can fork while it is single threaded."""
+    running = list(_running)
+    for monitor in running:
+        monitor.stop()
+    try:
+        yield
+    finally:
+        for monitor in running:
+            monitor.start()
+
+
+class GPUMonitor:
+    """Sample the GPU the process runs on, the first one in
+    CUDA_VISIBLE_DEVICES, with nvidia-smi in a background thread.
+
+    Parameters
+    ----------
+    interval : float, default 10
+        Seconds between samples
+    """
+    def __init__(self, interval=10):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _sample(self):
+        try:
+            device = visible_device()
+        except (OSError, subprocess.CalledProcessError, IndexError):
+            return
+        while not self._stop.is_set():
+            try:
+                self.samples.append(query_gpus(device)[0])
+            except (OSError, subprocess.CalledProcessError, IndexError):
+                return
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        _running.add(self)
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        _running.discard(self)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def summary(self):
+        """Dict of mean utilization, peak and total memory, or None if no
+        sample was taken."""
+        if len(self.samples) == 0:
+            return None
+        samples = np.array(self.samples)
+        return {
+            "gpu_utilization": float(np.mean(samples[:, 0])),
+            "gpu_memory_used": float(np.max(samples[:, 1])),
+            "gpu_memory_total": float(samples[0, 2]),
+        }
+
+
+class GPUMonitorHooks:
+    """signac-flow project hooks that store GPUMonitor.summary() in the job
+    document of every operation in `operations` that runs on a GPU, see
+    ngpu_directive.
+
+    Examples
+    --------
+    >>> project = PairMSIBI(environment=Fry)
+    >>> GPUMonitorHooks(operations=["optimize"]).install_project_hooks(project)
+    >>> project.main()
+    """
+    def __init__(self, operations=None, interval=10):
+        self.operations = operations
+        self.interval = interval
+        self._monitors = dict()
+
+    def _tracked(self, operation_name):
+        return self.operations is None or operation_name in self.operations
+
+    def on_start(self, operation_name, *jobs):
+        # Operations running on the CPU would record some GPU's load
+        if not self._tracked(operation_name) or ngpu_directive(jobs[0]) == 0:
+            return
+        monitor = GPUMonitor(interval=self.interval)
+        monitor.start()
+        self._monitors[(operation_name, jobs[0].id)] = monitor
+
+    def on_exit(self, operation_name, error, *jobs):
+        monitor = self._monitors.pop((operation_name, jobs[0].id), None)
+        if monitor is None:
+            return
+        monitor.stop()
+        summary = monitor.summary()
+        # Runs sharing a GPU measure the load of all of them, only keep
+        # what a job needs on its own
+        shared = int(os.environ.get("JOBS_PER_GPU", 1)) > 1
+        if summary is not None and error is None and not shared:
+            for job in jobs:
+                job.doc.update(summary)
+
+    def install_project_hooks(self, project):
+        project.project_hooks.on_start.append(self.on_start)
+        project.project_hooks.on_exit.append(self.on_exit)
+        return project
+
+
+def ngpu_directive(job):
+    """ngpu directive of an operation that runs on the CPU when the job
+    document sets cpu_threads, and on one GPU otherwise."""
+    return 0 if job.doc.get("cpu_threads") else 1
+
+
+def np_directive(job):
+    """np directive matching ngpu_directive: cpu_threads cores on the CPU,
+    one otherwise."""
+    return job.doc.get("cpu_threads") or 1
+
+
+def jobs_per_gpu(
+        utilization,
+        memory_used,
+        memory_total,
+        target_utilization=90,
+        max_jobs=8
+):
+    """Number of jobs with the given GPU needs that fit on one GPU.
+
+    Limited by both the summed utilization, which should stay below
+    target_utilization, and the summed memory.
+    """
+    n_util = int(target_utilization // max(utilization, 1.0))
+    n_memory = int(memory_total // max(memory_used, 1.0))
+    return max(1, min(n_util, n_memory, max_jobs))
+
+
+def recommend_jobs_per_gpu(project, target_utilization=90, max_jobs=8):
+    """jobs_per_gpu for the median measured job of a signac project, or
+    None if no job has GPU measurements yet."""
+    measured = [
+        job.doc for job in project
+        if job.doc.get("gpu_utilization") is not None
+    ]
+    if len(measured) == 0:
+        return None
+    return jobs_per_gpu(
+            utilization=np.median([d["gpu_utilization"] for d in measured]),
+            memory_used=np.median([d["gpu_memory_used"] for d in measured]),
+            memory_total=min(d["gpu_memory_total"] for d in measured),
+            target_utilization=target_utilization,
+            max_jobs=max_jobs
+    )
+
+
+if __name__ == "__main__":
+    import sys
+
+    import signac
+
+    project = signac.get_project(sys.argv[1] if len(sys.argv) > 1 else ".")
+    n = recommend_jobs_per_gpu(project)
+    if n is None:
+        print("No job of this project has GPU measurements yet.")
+    else:
+        print(f"Pack {n} jobs per GPU:")
+        print(f"    python project.py submit --bundle {n} --parallel "
+              f"--jobs-per-gpu {n}")
@@ -0,0 +1,267 @@
+import io
+import json
+import os
+import re
+
+import numpy as np
+
+CACHE_DIR = ".log-cache"
+
+
+def _column_names(header):
+    """Clean up a HOOMD log header the same way np.genfromtxt(names=True)
+    does, e.g. md.compute.ThermodynamicQuantities.volume becomes
+    mdcomputeThermodynamicQuantitiesvolume.
+    """
+    return [re.sub(r"[^\w]", "", name) for name in header.split()]
+
+
+def _parse_rows(fpath, offset=0):
+    """Parse every complete row of a HOOMD log file after a byte offset.
+
+    Returns the column names, the new rows as a 2D array and the byte
+    offset just past the last complete line that was parsed.
+    """
+    with open(fpath, "rb") as f:
+        header = f.readline()
+        if not header.endswith(b"\n"):
+            return None, np.empty((0, 0)), 0
+        names = _column_names(header.decode())
+        offset = max(offset, len(header))
+        f.seek(offset)
+        chunk = f.read()
+    # Skip a partially written last line, it gets picked up next time
+    end = chunk.rfind(b"\n") + 1
+    if end == 0:
+        return names, np.empty((0, len(names))), offset
+    rows = np.loadtxt(io.BytesIO(chunk[:end]), ndmin=2)
+    return names, rows, offset + end
+
+
+class LogTail:
+    """Incremental reader of a HOOMD log file that is still being written.
+
+    Remembers the byte offset of the last complete row it parsed, so each
+    call to `read` only parses rows appended since the previous call.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the log text file written by hoomd.write.Table
+    offset : int, default 0
+        Byte offset to resume reading from
+    """
+    def __init__(self, fpath, offset=0):
+        self.fpath = fpath
+        self.offset = offset
+        self.names = None
+
+    def read(self):
+        """Return a dict of column name: array of the newly appended rows."""
+        if not os.path.isfile(self.fpath):
+            return dict()
+        names, rows, self.offset = _parse_rows(self.fpath, self.offset)
+        if names is None:
+            return dict()
+        self.names = names
+        return {name: rows[:, idx] for idx, name in enumerate(names)}
+
+    def __iter__(self):
+        """Yield chunks of new rows until no new rows are found."""
+        while True:
+            new_rows = self.read()
+            if not new_rows or len(new_rows[self.names[0]]) == 0:
+                return
+            yield new_rows
+
+
+def tail_writer(tail, callback, period):
+    """Create a HOOMD writer that passes new log rows to `callback`.
+
+    Attach the returned writer to a running Simulation with
+    `sim.operations.writers.append(writer)`; every `period` steps any rows
+    appended to the log file since the last call are read and passed to
+    `callback` as a dict of column name: array.
+    """
+    import hoomd
+
+    class _TailAction(hoomd.custom.Action):
+        def act(self, timestep):
+            new_rows = tail.read()
+            if new_rows and len(new_rows[tail.names[0]]) > 0:
+                callback(new_rows)
+
+    return hoomd.write.CustomWriter(
+            action=_TailAction(),
+            trigger=hoomd.trigger.Periodic(int(period))
+    )
+
+
+class LogCache:
+    """Binary column cache of a single HOOMD log file.
+
+    Each column is stored as a raw float64 file in `cache_dir` and served
+    as a read-only memory map. The cache is keyed on the size and mtime
+    of the log file; when the log has grown only the new rows are parsed
+    and appended to the column files.
+
+    Parameters
+    ----------
+    fpath : str
+        Path to the log text file written by hoomd.write.Table
+    cache_dir : str, optional
+        Directory to store the column files in. Defaults to a directory
+        named after the log file inside `.log-cache` next to it.
+    """
+    def __init__(self, fpath, cache_dir=None):
+        self.fpath = os.path.abspath(fpath)
+        if cache_dir is None:
+            cache_dir = os.path.join(
+                    os.path.dirname(self.fpath),
+                    CACHE_DIR,
+                    os.path.basename(self.fpath)
+            )
+        self.cache_dir = cache_dir
+        self._meta_path = os.path.join(self.cache_dir, "meta.json")
+
+    def _load_meta(self):
+        if not os.path.isfile(self._meta_path):
+            return None
+        with open(self._meta_path, "r") as f:
+            return json.load(f)
+
+    def _save_meta(self, meta):
+        tmp_path = self._meta_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self._meta_path)
+
+    def _column_path(self, name):
+        return os.path.join(self.cache_dir, f"{name}.f8")
+
+    def _lock(self):
+        """Exclusive lock on the cache directory, held while updating."""
+        import fcntl
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        lock = open(os.path.join(self.cache_dir, "lock"), "w")
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        return lock
+
+    def _rewritten(self, meta, stat):
+        """Whether the log was rewritten since meta was saved.
+
+        A log that shrank, was replaced by a new file, or no longer has the
+        cached bytes in front of the cached offset, e.g. after a rerun that
+        already wrote more than the old log, can't be appended to.
+        """
+        if stat.st_size < meta["offset"] or stat.st_ino != meta.get("inode"):
+            return True
+        check = meta.get("check", "").encode("latin-1")
+        with open(self.fpath, "rb") as f:
+            if f.readline().decode("latin-1") != meta.get("header"):
+                return True
+            f.seek(meta["offset"] - len(check))
+            return f.read(len(check)) != check
+
+    def update(self):
+        """Bring the cache up to date with the log file.
+
+        Returns the cache metadata (column names, number of rows, etc.).
+        Concurrent updates of the same cache are serialized with a lock
+        file.
+        """
+        stat = os.stat(self.fpath)
+        meta = self._load_meta()
+        if (
+                meta is not None
+                and meta["size"] == stat.st_size
+                and meta["mtime"] == stat.st_mtime
+                and meta.get("inode") == stat.st_ino
+        ):
+            return meta
+        with self._lock():
+            return self._update()
+
+    def _update(self):
+        stat = os.stat(self.fpath)
+        meta = self._load_meta()
+        if meta is not None:
+            if (
+                    meta["size"] == stat.st_size
+                    and meta["mtime"] == stat.st_mtime
+                    and meta.get("inode") == stat.st_ino
+            ):
+                return meta
+            if self._rewritten(meta, stat):
+                meta = None
+        tail = LogTail(self.fpath, offset=0 if meta is None else meta["offset"])
+        new_rows = tail.read()
+        if not new_rows:
+            # The header line hasn't been written yet
+            return {"names": [], "n_rows": 0, "offset": 0}
+        if meta is None:
+            meta = {"names": tail.names, "n_rows": 0, "offset": 0}
+            for name in tail.names:
+                # Replace instead of truncating, arrays returned by columns()
+                # may still map the old file
+                path = self._column_path(name)
+                open(path + ".tmp", "wb").close()
+                os.replace(path + ".tmp", path)
+        n_new = len(new_rows[tail.names[0]])
+        if n_new > 0:
+            for name in meta["names"]:
+                with open(self._column_path(name), "r+b") as f:
+                    # Drop rows left by an interrupted update, which meta
+                    # doesn't count, before appending
+                    f.truncate(meta["n_rows"] * 8)
+                    f.seek(0, os.SEEK_END)
+                    f.write(np.ascontiguousarray(new_rows[name]).tobytes())
+            meta["n_rows"] += n_new
+        with open(self.fpath, "rb") as f:
+            meta["header"] = f.readline().decode("latin-1")
+            start = max(tail.offset - 256, len(meta["header"]))
+            f.seek(start)
+            meta["check"] = f.read(tail.offset - start).decode("latin-1")
+        meta["offset"] = tail.offset
+        meta["size"] = stat.st_size
+        meta["mtime"] = stat.st_mtime
+        meta["inode"] = stat.st_ino
+        self._save_meta(meta)
+        return meta
+
+    @property
+    def names(self):
+        return self.update()["names"]
+
+    def column(self, name):
+        """Return a read-only memory mapped array of one log column."""
+        return self.columns([name])[name]
+
+    def columns(self, names):
+        """Return a dict of read-only memory mapped arrays of log columns."""
+        meta = self.update()
+        return {name: self._memmap(name, meta) for name in names}
+
+    def _memmap(self, name, meta):
+        if name not in meta["names"]:
+            raise ValueError(
+                    f"Column {name} not found in {self.fpath}. "
+                    f"Choose from {meta['names']}"
+            )
+        if meta["n_rows"] == 0:
+            return np.empty(0)
+        return np.memmap(
+                self._column_path(name),
+                dtype=np.float64,
+                mode="r",
+                shape=(meta["n_rows"],)
+        )
+
+    def __getitem__(self, name):
+        return self.column(name)
+
+
+def log_column(fpath, value):
+    """Return a single column of a HOOMD log file using the column cache."""
+    return LogCache(fpath).column(value)
@@ -0,0 +1,842 @@
+"""Extensions of the msibi.MSIBI optimizer used by the MSIBI flow projects.
+
+Kept out of utils/__init__.py so that the rest of the utils package can be
+used without msibi installed.
+"""
+import contextlib
+import functools
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+
+import gsd.hoomd
+import numpy as np
+from msibi import MSIBI
+
+from .distributions import (
+    BondedAccumulator,
+    PairAccumulator,
+    accumulator_writer
+)
+from .gpu import monitors_paused
+
+CHECKPOINT_FILE = "checkpoint.npz"
+QUERY_DISTRIBUTIONS_FILE = "query-distributions.npz"
+TARGET_CACHE_DIR = "target-distributions"
+
+_file_hashes = dict()
+
+
+def _file_hash(fpath):
+    """sha1 of a file's contents, remembered per size and mtime."""
+    stat = os.stat(fpath)
+    key = (os.path.abspath(fpath), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        h = hashlib.sha1()
+        with open(fpath, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _file_hashes[key] = h.hexdigest()
+    return _file_hashes[key]
+
+
+def target_distribution_key(force, state):
+    """Cache key of the target distribution of a force for a state.
+
+    Made from the contents of the target trajectory, the frames used and
+    every force setting the distribution depends on, but not the potential,
+    so jobs that only differ in e.g. epsilon or sigma share it.
+    """
+    x_range = getattr(force, "x_range", None)
+    key_data = json.dumps(
+            {
+                "trajectory": _file_hash(state.traj_file),
+                "n_frames": state.n_frames,
+                "sampling_stride": getattr(state, "sampling_stride", None),
+                "force": type(force).__name__,
+                "name": force.name,
+                "nbins": getattr(force, "nbins", None),
+                "r_cut": getattr(force, "r_cut", None),
+                "x_range": None if x_range is None else [
+                    float(x_range[0]), float(x_range[-1]), len(x_range)
+                ],
+                "exclude_bonded": getattr(force, "exclude_bonded", None),
+            },
+            sort_keys=True
+    )
+    return hashlib.sha1(key_data.encode()).hexdigest()
+
+
+def cached_target_distribution(force, state, compute):
+    """Target distribution of a force for a state, computed at most once.
+
+    Distributions are stored as .npy files in a target-distributions
+    directory next to the target trajectory, so every optimizer job using
+    the same target job finds them. If that directory can't be written to,
+    the distribution is still returned, just not cached.
+
+    Parameters
+    ----------
+    force : msibi.forces.Force
+    state : msibi.state.State
+    compute : callable
+        Called without arguments to compute the distribution on a miss
+    """
+    cache_dir = os.path.join(
+            os.path.dirname(os.path.abspath(state.traj_file)),
+            TARGET_CACHE_DIR
+    )
+    fpath = os.path.join(
+            cache_dir, f"{target_distribution_key(force, state)}.npy"
+    )
+    if os.path.isfile(fpath):
+        return np.load(fpath)
+    distribution = compute()
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        # Unique temporary name, several jobs may compute the same target
+        tmp_path = f"{fpath}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, np.asarray(distribution))
+        os.replace(tmp_path, fpath)
+    except OSError:
+        pass
+    return distribution
+
+
+def checkpoint_progress(checkpoint_dir):
+    """Progress stored in an optimizer checkpoint, None if there is none.
+
+    Returns a dict with the stage index, the number of iterations completed
+    in that stage and the total number of completed iterations. Can be
+    called before any State is created, e.g. to decide what to do with an
+    existing states directory.
+    """
+    fpath = os.path.join(checkpoint_dir, CHECKPOINT_FILE)
+    if not os.path.isfile(fpath):
+        return None
+    with np.load(fpath) as data:
+        return json.loads(str(data["meta"]))
+
+
+class MSIBIOptimizer(MSIBI):
+    """msibi.MSIBI with extra execution modes.
+
+    Parameters
+    ----------
+    parallel_states : bool, default False
+        Run the CG simulations of all states of an iteration at the same
+        time, each in its own process, instead of one after another. The
+        potential update waits for every state to finish. The state
+        simulations only talk to the optimizer through their query
+        trajectories, so nothing needs to be sent back from the processes.
+    n_workers : int, optional
+        Maximum number of state simulations to run at once when
+        parallel_states is True, defaults to the number of states.
+    checkpoint_dir : str, optional
+        Directory to write a checkpoint to after every iteration. It holds
+        the potential, potential history, current distribution and fit
+        scores of every optimized force, the stage and iteration counters
+        and the last CG frame of every state. See load_checkpoint.
+    cache_targets : bool, default True
+        Reuse target distributions computed by earlier jobs with the same
+        target trajectory and force settings, see
+        cached_target_distribution.
+    warm_start : bool, default False
+        Start each state's simulation from the last frame of its previous
+        iteration instead of from the target trajectory. The first
+        iteration, and the first after a restart without a checkpoint
+        snapshot, still start from the target.
+    discard_steps : int, default 0
+        With warm_start, drop the query frames written during the first
+        discard_steps of every warm-started run, so the query distribution
+        is only sampled after the system has relaxed to the new potential.
+        With accumulate_distributions, no run is sampled during its first
+        discard_steps.
+    accumulate_distributions : bool, default False
+        Build the query distributions of every force inside the HOOMD run
+        (see utils.distributions) instead of writing a query trajectory
+        and reading it back. Frames are sampled every sample_period steps
+        after the first discard_steps of each run. A GSD trajectory is only
+        written when backup_trajectories is set, plus the last frame for
+        warm starts.
+    sample_period : int, optional
+        Steps between sampled frames with accumulate_distributions,
+        defaults to gsd_period
+    device : str, optional
+        "cpu" or "gpu", defaults to hoomd.device.auto_select. The device is
+        built explicitly for every state simulation, including the ones
+        msibi sets up itself, see _msibi_device.
+    num_cpu_threads : int, optional
+        Total threads of the HOOMD CPU devices of all state simulations.
+        With parallel_states they are split over the states running at
+        once.
+    nlist_buffer : float or str, optional
+        Neighbor list buffer distance. "tune" times short runs of the first
+        state with buffers between 5 and 30 % of the largest pair r_cut
+        before the first iteration and keeps the fastest, see
+        tune_nlist_buffer.
+
+    All other arguments are passed on to msibi.MSIBI.
+    """
+    def __init__(
+            self,
+            *args,
+            parallel_states=False,
+            n_workers=None,
+            checkpoint_dir=None,
+            cache_targets=True,
+            warm_start=False,
+            discard_steps=0,
+            accumulate_distributions=False,
+            sample_period=None,
+            device=None,
+            num_cpu_threads=None,
+            nlist_buffer=None,
+            **kwargs
+    ):
+        super(MSIBIOptimizer, self).__init__(*args, **kwargs)
+        self.device = device
+        self.num_cpu_threads = num_cpu_threads
+        self._nlist = self.nlist
+        self.nlist_buffer = None
+        if nlist_buffer == "tune":
+            self._tune_nlist_buffer = True
+        else:
+            self._tune_nlist_buffer = False
+            if nlist_buffer is not None:
+                self.set_nlist_buffer(nlist_buffer)
+        self.cache_targets = cache_targets
+        self.warm_start = warm_start
+        self.discard_steps = int(discard_steps)
+        self.accumulate_distributions = accumulate_distributions
+        self.sample_period = sample_period
+        self.parallel_states = parallel_states
+        self.n_workers = n_workers
+        self.checkpoint_dir = checkpoint_dir
+        # Index of the current entry of a multi-stage schedule and the
+        # number of iterations already done in it
+        self.stage = 0
+        self.stage_iteration = 0
+        # Current simulation length of run_adaptive_optimization
+        self.n_steps = None
+
+    def add_force(self, force):
+        self._wrap_state_distributions(force)
+        super(MSIBIOptimizer, self).add_force(force)
+
+    def _wrap_state_distributions(self, force):
+        # Forces compute every state's target distribution through
+        # _get_state_distr(state, query=False) when they are added, and the
+        # query distributions through _get_state_distr(state, query=True)
+        # when the potential is updated
+        get_state_distr = force._get_state_distr
+
+        def _get_state_distr(state, query):
+            if query and self.accumulate_distributions:
+                return self._load_query_distribution(force, state)
+            if not query and self.cache_targets:
+                return cached_target_distribution(
+                        force,
+                        state,
+                        lambda: get_state_distr(state=state, query=query)
+                )
+            return get_state_distr(state=state, query=query)
+
+        force._get_state_distr = _get_state_distr
+
+    def _run_state(self, state, n_steps, forces, backup_trajectories):
+        snapshot = self._snapshot_path(state)
+        warm_start = self.warm_start and os.path.isfile(snapshot)
+        traj_file = state.traj_file
+        start = time.perf_counter()
+        if warm_start:
+            # The simulation is set up from state.traj_file; the target
+            # distribution was already computed from it when the state was
+            # added, so it is safe to point it at the snapshot for this run.
+            state.traj_file = snapshot
+        try:
+            if self.accumulate_distributions:
+                self._run_accumulating(
+                        state,
+                        n_steps,
+                        forces,
+                        backup_trajectories,
+                        thermalize=not warm_start
+                )
+            else:
+                self._run_simulation(
+                        state, n_steps, forces, backup_trajectories
+                )
+        finally:
+            state.traj_file = traj_file
+        elapsed = time.perf_counter() - start
+        print(
+            f"State {state.name}: {n_steps} steps in {elapsed:.0f} s, "
+            f"{n_steps / elapsed:.1f} TPS including setup"
+        )
+        if (
+                warm_start
+                and self.discard_steps > 0
+                and not self.accumulate_distributions
+        ):
+            self._discard_frames(state)
+
+    def _accumulators(self, state):
+        from msibi import Angle, Bond, Dihedral, Pair
+
+        kinds = {Bond: "bonds", Angle: "angles", Dihedral: "dihedrals"}
+        accumulators = []
+        for force in self.forces:
+            # Bin the query distribution on the grid of the target one
+            x = force._states[state]["target_distribution"][:, 0]
+            if isinstance(force, Pair):
+                accumulators.append(PairAccumulator(
+                        force.type1,
+                        force.type2,
+                        x,
+                        exclude_bonded=force.exclude_bonded
+                ))
+            else:
+                kind = next(
+                        kinds[cls] for cls in kinds if isinstance(force, cls)
+                )
+                accumulators.append(BondedAccumulator(kind, force.name, x))
+        return accumulators
+
+    def set_nlist_buffer(self, buffer):
+        """Use a neighbor list buffer distance for all following runs."""
+        self.nlist_buffer = float(buffer)
+        self.nlist = functools.partial(self._nlist, buffer=self.nlist_buffer)
+
+    def _device(self):
+        import hoomd
+
+        if self.device == "cpu":
+            num_cpu_threads = self.num_cpu_threads
+            if num_cpu_threads is not None and self.parallel_states:
+                # Split the threads over the states running at once
+                n_parallel = min(
+                        self.n_workers or len(self.states), len(self.states)
+                )
+                num_cpu_threads = max(1, num_cpu_threads // n_parallel)
+            return hoomd.device.CPU(num_cpu_threads=num_cpu_threads)
+        if self.device == "gpu":
+            return hoomd.device.GPU()
+        return hoomd.device.auto_select()
+
+    def _build_simulation(self, state, forces, thermalize=True):
+        import hoomd
+
+        device = self._device()
+        sim = hoomd.Simulation(device=device, seed=self.seed)
+        sim.create_state_from_gsd(filename=state.traj_file, frame=-1)
+        integrator = hoomd.md.Integrator(dt=self.dt)
+        integrator.forces = forces
+        if self.thermostat is None:
+            method = self.integrator_method(
+                    filter=hoomd.filter.All(),
+                    kT=state.kT,
+                    **self.method_kwargs
+            )
+        else:
+            method = self.integrator_method(
+                    filter=hoomd.filter.All(),
+                    thermostat=self.thermostat(
+                        kT=state.kT, **self.thermostat_kwargs
+                    ),
+                    **self.method_kwargs
+            )
+        integrator.methods = [method]
+        sim.operations.integrator = integrator
+        if thermalize:
+            sim.state.thermalize_particle_momenta(
+                    filter=hoomd.filter.All(), kT=state.kT
+            )
+        return sim
+
+    def tune_nlist_buffer(self, buffers=None, n_steps=5000):
+        """Time short runs of the first state with each neighbor list
+        buffer and keep the fastest.
+
+        Parameters
+        ----------
+        buffers : list of float, optional
+            Buffers to try, defaults to 5, 10, 15, 20 and 30 % of the
+            largest pair r_cut
+        n_steps : int, default 5000
+            Steps to time per buffer, after as many warm-up steps
+
+        Returns
+        -------
+        dict
+            Buffer: timesteps per second
+        """
+        if buffers is None:
+            r_cut = max(
+                [getattr(force, "r_cut", 0) or 0 for force in self.forces]
+                + [1.0]
+            )
+            buffers = [r_cut * f for f in (0.05, 0.1, 0.15, 0.2, 0.3)]
+        # Time every buffer in its own forked process, so that no HOOMD
+        # device (CUDA context) exists in this process when the states are
+        # forked later
+        context = multiprocessing.get_context("fork")
+        tps = dict()
+        for buffer in buffers:
+            queue = context.Queue()
+            process = context.Process(
+                    target=self._time_nlist_buffer,
+                    args=(buffer, n_steps, queue)
+            )
+            with monitors_paused():
+                process.start()
+            process.join()
+            if process.exitcode != 0:
+                raise RuntimeError(
+                        f"Timing the nlist buffer {buffer} failed."
+                )
+            tps[buffer] = queue.get()
+            print(f"nlist buffer {buffer:.3f}: {tps[buffer]:.1f} TPS")
+        self.set_nlist_buffer(max(tps, key=tps.get))
+        print(f"Using nlist buffer {self.nlist_buffer:.3f}")
+        return tps
+
+    def _time_nlist_buffer(self, buffer, n_steps, queue):
+        self.set_nlist_buffer(buffer)
+        sim = self._build_simulation(self.states[0], self._build_force_objs())
+        sim.run(n_steps)
+        start = time.perf_counter()
+        sim.run(n_steps)
+        queue.put(n_steps / (time.perf_counter() - start))
+
+    def _run_accumulating(
+            self, state, n_steps, forces, backup_trajectories, thermalize
+    ):
+        import hoomd
+
+        sim = self._build_simulation(state, forces, thermalize=thermalize)
+        accumulators = self._accumulators(state)
+        sample_trigger = hoomd.trigger.And([
+            hoomd.trigger.Periodic(int(self.sample_period or self.gsd_period)),
+            hoomd.trigger.After(sim.timestep + self.discard_steps),
+        ])
+        sim.operations.writers.append(
+                accumulator_writer(accumulators, sample_trigger)
+        )
+        if backup_trajectories:
+            sim.operations.writers.append(hoomd.write.GSD(
+                    filename=os.path.join(
+                        state.dir, f"query{self.n_iterations}.gsd"
+                    ),
+                    trigger=hoomd.trigger.Periodic(int(self.gsd_period)),
+                    mode="wb",
+            ))
+        sim.run(n_steps)
+
+        # The last frame is all that's needed from the query trajectory
+        hoomd.write.GSD.write(
+                state=sim.state, filename=state.query_traj, mode="wb"
+        )
+        if sim.device.communicator.rank == 0:
+            self._save_query_distributions(state, accumulators)
+
+    def _save_query_distributions(self, state, accumulators):
+        arrays = dict()
+        for i, (force, accumulator) in enumerate(
+                zip(self.forces, accumulators)
+        ):
+            distribution = accumulator.distribution()
+            if isinstance(accumulator, BondedAccumulator):
+                # Use the same normalization as the target histogram
+                target = force._states[state]["target_distribution"][:, 1]
+                total = np.sum(distribution[:, 1])
+                if total > 0:
+                    distribution[:, 1] *= np.sum(target) / total
+            arrays[f"force{i}"] = distribution
+        np.savez(os.path.join(state.dir, QUERY_DISTRIBUTIONS_FILE), **arrays)
+
+    def _load_query_distribution(self, force, state):
+        fpath = os.path.join(state.dir, QUERY_DISTRIBUTIONS_FILE)
+        with np.load(fpath) as data:
+            return data[f"force{self.forces.index(force)}"]
+
+    def _discard_frames(self, state):
+        with gsd.hoomd.open(state.query_traj, "r") as traj:
+            steps = np.array([
+                traj.file.read_chunk(frame=i, name="configuration/step")[0]
+                if traj.file.chunk_exists(frame=i, name="configuration/step")
+                else 0
+                for i in range(len(traj))
+            ])
+            keep = np.nonzero(steps >= steps.min() + self.discard_steps)[0]
+            if len(keep) == len(traj):
+                return
+            frames = [traj[int(i)] for i in keep]
+        tmp_path = state.query_traj + ".tmp"
+        with gsd.hoomd.open(tmp_path, "w") as traj:
+            traj.extend(frames)
+        os.replace(tmp_path, state.query_traj)
+
+    @contextlib.contextmanager
+    def _msibi_device(self):
+        """Have msibi, which builds its simulations on
+        hoomd.device.auto_select(), use the device of this optimizer while
+        inside the context. auto_select is restored on exit."""
+        import hoomd
+
+        if self.device is None:
+            yield
+            return
+        auto_select = hoomd.device.auto_select
+        hoomd.device.auto_select = lambda *args, **kwargs: self._device()
+        try:
+            yield
+        finally:
+            hoomd.device.auto_select = auto_select
+
+    def _run_simulation(self, state, n_steps, forces, backup_trajectories):
+        with self._msibi_device():
+            state._run_simulation(
+                n_steps=n_steps,
+                forces=forces,
+                integrator_method=self.integrator_method,
+                method_kwargs=self.method_kwargs,
+                thermostat=self.thermostat,
+                thermostat_kwargs=self.thermostat_kwargs,
+                dt=self.dt,
+                seed=self.seed,
+                iteration=self.n_iterations,
+                gsd_period=self.gsd_period,
+                backup_trajectories=backup_trajectories,
+            )
+
+    def _run_states_parallel(self, n_steps, forces, backup_trajectories):
+        # Fork so the children inherit the states and force objects as is;
+        # no HOOMD device exists in this process yet, and the GPU monitor
+        # threads are paused while forking, so the process is single
+        # threaded when it forks.
+        context = multiprocessing.get_context("fork")
+        n_workers = self.n_workers or len(self.states)
+        for batch_start in range(0, len(self.states), n_workers):
+            batch = self.states[batch_start:batch_start + n_workers]
+            processes = []
+            with monitors_paused():
+                for state in batch:
+                    process = context.Process(
+                        target=self._run_state,
+                        args=(state, n_steps, forces, backup_trajectories),
+                        name=f"msibi-state-{state.name}",
+                    )
+                    process.start()
+                    processes.append(process)
+            # Barrier: every state must finish before the potential update
+            for process in processes:
+                process.join()
+            failed = [
+                state.name for state, process in zip(batch, processes)
+                if process.exitcode != 0
+            ]
+            if failed:
+                raise RuntimeError(
+                    f"The simulations of states {failed} failed during "
+                    f"iteration {self.n_iterations}."
+                )
+
+    def _run_states(self, n_steps, backup_trajectories):
+        if self._tune_nlist_buffer:
+            self.tune_nlist_buffer()
+            self._tune_nlist_buffer = False
+        forces = self._build_force_objs()
+        if self.parallel_states:
+            self._run_states_parallel(n_steps, forces, backup_trajectories)
+        else:
+            for state in self.states:
+                self._run_state(state, n_steps, forces, backup_trajectories)
+
+    def _update_potentials(self):
+        for force in self.forces:
+            if force.optimize:
+                force._update_potential()
+
+    def _optimized_forces(self):
+        return [force for force in self.forces if force.optimize]
+
+    def save_checkpoint(self, stage=None, stage_iteration=None):
+        """Write the optimizer state to checkpoint_dir.
+
+        Parameters
+        ----------
+        stage : int, optional
+            Stage index to record, defaults to the current stage
+        stage_iteration : int, optional
+            Iterations completed in that stage, defaults to the current
+            count. Pass stage + 1 and 0 once a stage and any post-processing
+            of it (smoothing etc.) is done.
+        """
+        if stage is not None:
+            self.stage = stage
+            self.stage_iteration = 0
+        if stage_iteration is not None:
+            self.stage_iteration = stage_iteration
+        os.makedirs(self.checkpoint_dir, exist_ok=True)
+        meta = {
+            "stage": self.stage,
+            "stage_iteration": self.stage_iteration,
+            "n_iterations": self.n_iterations,
+            "n_steps": self.n_steps,
+            "forces": [force.name for force in self._optimized_forces()],
+            "states": [state.name for state in self.states],
+        }
+        arrays = {"meta": np.array(json.dumps(meta))}
+        for i, force in enumerate(self._optimized_forces()):
+            arrays[f"force{i}_potential"] = np.asarray(force.potential)
+            arrays[f"force{i}_potential_history"] = np.asarray(
+                    force.potential_history
+            )
+            for j, state in enumerate(self.states):
+                state_data = force._states[state]
+                arrays[f"force{i}_state{j}_f_fit"] = np.asarray(
+                        state_data["f_fit"]
+                )
+                if state_data.get("current_distribution") is not None:
+                    arrays[f"force{i}_state{j}_current_distribution"] = (
+                            np.asarray(state_data["current_distribution"])
+                    )
+        for state in self.states:
+            self._save_snapshot(state)
+        # Everything needed to resume is in one file that is replaced in a
+        # single step, so a job killed mid-write keeps the previous one.
+        fpath = os.path.join(self.checkpoint_dir, CHECKPOINT_FILE)
+        tmp_path = fpath + ".tmp.npz"
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, fpath)
+
+    def _snapshot_path(self, state):
+        if self.checkpoint_dir is None:
+            return os.path.join(state.dir, "last.gsd")
+        return os.path.join(self.checkpoint_dir, f"{state.name}-last.gsd")
+
+    def _save_snapshot(self, state):
+        if not os.path.isfile(state.query_traj):
+            return
+        with gsd.hoomd.open(state.query_traj, "r") as traj:
+            if len(traj) == 0:
+                return
+            frame = traj[-1]
+        fpath = self._snapshot_path(state)
+        tmp_path = fpath + ".tmp"
+        with gsd.hoomd.open(tmp_path, "w") as traj:
+            traj.append(frame)
+        os.replace(tmp_path, fpath)
+
+    def load_checkpoint(self):
+        """Restore the optimizer state from checkpoint_dir.
+
+        Call after all states and forces have been added, in the same order
+        as when the checkpoint was written.
+
+        Returns
+        -------
+        bool
+            True if a checkpoint was found and loaded
+        """
+        progress = checkpoint_progress(self.checkpoint_dir)
+        if progress is None:
+            return False
+        forces = self._optimized_forces()
+        if (
+                progress["forces"] != [force.name for force in forces]
+                or progress["states"] != [state.name for state in self.states]
+        ):
+            raise ValueError(
+                    f"The checkpoint in {self.checkpoint_dir} was written for "
+                    f"forces {progress['forces']} and states "
+                    f"{progress['states']}, which don't match this optimizer."
+            )
+        fpath = os.path.join(self.checkpoint_dir, CHECKPOINT_FILE)
+        with np.load(fpath) as data:
+            for i, force in enumerate(forces):
+                force.potential = data[f"force{i}_potential"]
+                force.potential_history = list(
+                        data[f"force{i}_potential_history"]
+                )
+                for j, state in enumerate(self.states):
+                    state_data = force._states[state]
+                    state_data["f_fit"] = list(data[f"force{i}_state{j}_f_fit"])
+                    key = f"force{i}_state{j}_current_distribution"
+                    if key in data.files:
+                        state_data["current_distribution"] = data[key]
+        self.stage = progress["stage"]
+        self.stage_iteration = progress["stage_iteration"]
+        self.n_iterations = progress["n_iterations"]
+        self.n_steps = progress.get("n_steps")
+        return True
+
+    def run_optimization(
+            self,
+            n_steps,
+            n_iterations,
+            backup_trajectories=False,
+            stage=None
+    ):
+        """Run MSIBI iterations.
+
+        Parameters
+        ----------
+        n_steps : int
+            Number of simulation steps per state per iteration
+        n_iterations : int
+            Number of iterations to run
+        backup_trajectories : bool, default False
+            Keep a copy of every state's query trajectory
+        stage : int, optional
+            Index of this call in a multi-stage schedule. With a loaded
+            checkpoint, stages that are already done are skipped and the
+            current stage only runs its remaining iterations.
+        """
+        start = 0
+        if stage is None:
+            self.stage_iteration = 0
+        elif stage < self.stage:
+            return
+        elif stage == self.stage:
+            start = self.stage_iteration
+        else:
+            self.stage = stage
+            self.stage_iteration = 0
+        for n in range(start, n_iterations):
+            print(f"---Optimization: {n + 1} of {n_iterations}---")
+            self._iterate(n_steps, backup_trajectories)
+            self._save_progress()
+
+    def _iterate(self, n_steps, backup_trajectories):
+        self._run_states(int(n_steps), backup_trajectories)
+        self._update_potentials()
+        self.n_iterations += 1
+        self.stage_iteration += 1
+
+    def _save_progress(self):
+        if self.checkpoint_dir is not None:
+            self.save_checkpoint()
+        elif self.warm_start:
+            for state in self.states:
+                self._save_snapshot(state)
+
+    def fit_score_history(self):
+        """Fit score of every iteration, averaged over the optimized forces
+        and the states."""
+        scores = [
+            np.asarray(force._states[state]["f_fit"], dtype=np.float64)
+            for force in self._optimized_forces()
+            for state in self.states
+        ]
+        n = min(len(score) for score in scores)
+        return np.mean([score[:n] for score in scores], axis=0)
+
+    def _last_potential_updates(self):
+        """The last two potential updates of all optimized forces, each
+        concatenated into one vector, or None before there are two."""
+        updates = []
+        for force in self._optimized_forces():
+            history = np.asarray(force.potential_history, dtype=np.float64)
+            if len(history) < 3:
+                return None
+            updates.append(np.diff(history[-3:], axis=0))
+        previous, last = np.concatenate(updates, axis=1)
+        finite = np.isfinite(previous) & np.isfinite(last)
+        return previous[finite], last[finite]
+
+    def _noise_dominated(self, noise_threshold):
+        # Updates driven by the remaining error keep pointing the same way,
+        # updates driven by sampling noise flip back and forth
+        updates = self._last_potential_updates()
+        if updates is None:
+            return False
+        previous, last = updates
+        norm = np.linalg.norm(previous) * np.linalg.norm(last)
+        if norm == 0:
+            return False
+        return np.dot(previous, last) / norm < noise_threshold
+
+    def _converged(self, fit_tolerance, patience):
+        scores = self.fit_score_history()
+        if len(scores) <= patience:
+            return False
+        improvement = np.max(scores[-patience:]) - np.max(scores[:-patience])
+        return improvement < fit_tolerance
+
+    def run_adaptive_optimization(
+            self,
+            n_steps,
+            max_steps,
+            max_iterations,
+            fit_tolerance=1e-3,
+            patience=5,
+            step_factor=2.0,
+            noise_threshold=0.0,
+            smoothing_period=None,
+            backup_trajectories=False
+    ):
+        """Run MSIBI iterations until the fit scores stop improving.
+
+        Simulations start at n_steps and are made step_factor times longer
+        whenever sampling noise dominates the potential update, i.e. the
+        cosine similarity of the last two potential updates drops below
+        noise_threshold, up to max_steps. The run stops once the best fit
+        score (averaged over forces and states, 1 is a perfect match) of
+        the last patience iterations is less than fit_tolerance better than
+        the best one before them, or after max_iterations.
+
+        Resumes from a loaded checkpoint, including the current n_steps.
+
+        Parameters
+        ----------
+        n_steps : int
+            Initial number of simulation steps per state per iteration
+        max_steps : int
+            Longest simulation to run
+        max_iterations : int
+            Maximum total number of iterations
+        fit_tolerance : float, default 1e-3
+        patience : int, default 5
+            Number of iterations to look back over for improvement
+        step_factor : float, default 2.0
+        noise_threshold : float, default 0.0
+        smoothing_period : int, optional
+            Smooth the optimized potentials every smoothing_period iterations
+        backup_trajectories : bool, default False
+            Keep a copy of every state's query trajectory
+
+        Returns
+        -------
+        bool
+            True if the fit scores converged before max_iterations
+        """
+        if self.n_steps is None:
+            self.n_steps = int(n_steps)
+        while self.stage_iteration < max_iterations:
+            if self._converged(fit_tolerance, patience):
+                print(f"Fit scores converged after {self.n_iterations} "
+                      "iterations")
+                return True
+            print(
+                f"---Optimization: {self.stage_iteration + 1} of at most "
+                f"{max_iterations}, {self.n_steps} steps---"
+            )
+            self._iterate(self.n_steps, backup_trajectories)
+            if (
+                    smoothing_period
+                    and self.stage_iteration % smoothing_period == 0
+            ):
+                for force in self._optimized_forces():
+                    force.smooth_potential()
+            if self.n_steps < max_steps and self._noise_dominated(
+                    noise_threshold
+            ):
+                self.n_steps = int(min(self.n_steps * step_factor, max_steps))
+                print(f"Sampling noise dominates the update, increasing "
+                      f"n_steps to {self.n_steps}")
+            self._save_progress()
+        return self._converged(fit_tolerance, patience)
@@ -0,0 +1,192 @@
+"""Radius of gyration, end-to-end distance and persistence length in one pass.
+
+Replaces calling cmeutils.polymers.radius_of_gyration, end_to_end_distance
+and persistence_length one after another, which reads the trajectory three
+times and builds an MDAnalysis universe for the persistence length. Here
+every frame is read once (positions and box only), and all chains of equal
+length are handled together as (n_chains, n_particles, 3) arrays.
+
+Chains are the bond-connected molecules of the first frame, ordered by
+particle index. They are unwrapped by summing minimum image bond vectors
+from the first particle, so the result doesn't depend on the stored images
+even when a chain is longer than half the box.
+"""
+import numpy as np
+from scipy.optimize import curve_fit
+
+from .distributions import _minimum_image, molecule_ids
+from .trajectory import MultiTrajectory
+
+
+def chains(n_particles, bonds):
+    """Particle indices of every molecule, grouped by molecule length.
+
+    Returns a list of (n_chains, length) index arrays.
+    """
+    ids = molecule_ids(n_particles, bonds)
+    order = np.argsort(ids, kind="stable")
+    sizes = np.bincount(ids)
+    members = np.split(order, np.cumsum(sizes)[:-1])
+    groups = []
+    for length in np.unique(sizes):
+        groups.append(np.stack([m for m in members if len(m) == length]))
+    return groups
+
+
+def _bond_vectors(positions, box, chain_indices):
+    """Minimum image vectors between consecutive particles of every chain,
+    shape (n_chains, length - 1, 3)."""
+    pos = positions[chain_indices]
+    b = pos[:, 1:] - pos[:, :-1]
+    return _minimum_image(b.reshape(-1, 3), box).reshape(b.shape)
+
+
+def _unwrap_chains(positions, bond_vectors, chain_indices):
+    x = np.zeros(chain_indices.shape + (3,))
+    x[:, 1:] = np.cumsum(bond_vectors, axis=1)
+    return x + positions[chain_indices[:, :1]]
+
+
+def bond_autocorrelation_sum(bond_vectors):
+    """sum over chains and bonds i of u_i . u_(i+n) for every n, with u the
+    unit bond vectors, by FFT along the chain."""
+    u = bond_vectors / np.linalg.norm(bond_vectors, axis=-1, keepdims=True)
+    n_bonds = u.shape[1]
+    n_fft = 1 << int(np.ceil(np.log2(2 * n_bonds)))
+    f = np.fft.rfft(u, n=n_fft, axis=1)
+    power = np.sum(f.real ** 2 + f.imag ** 2, axis=(0, 2))
+    return np.fft.irfft(power, n=n_fft)[:n_bonds]
+
+
+def fit_persistence_length(bond_autocorrelation, bond_length):
+    """Fit exp(-x / lp) with x = n * bond_length, like MDAnalysis'
+    PersistenceLength."""
+    x = bond_length * np.arange(len(bond_autocorrelation))
+    return curve_fit(
+            lambda x, lp: np.exp(-x / lp), x, bond_autocorrelation, p0=[1.0]
+    )[0][0]
+
+
+def _backbone(frame, groups, backbone_types):
+    """Backbone particle indices of every chain as one (n_chains, length)
+    array."""
+    mask = np.ones(frame.particles.N, dtype=bool)
+    if backbone_types is not None:
+        types = list(frame.particles.types)
+        ids = [types.index(t) for t in backbone_types]
+        mask = np.isin(frame.particles.typeid, ids)
+    backbones = [
+        np.stack([chain[mask[chain]] for chain in group]) for group in groups
+    ]
+    backbones = [b for b in backbones if b.shape[1] > 1]
+    if len({b.shape[1] for b in backbones}) != 1:
+        raise ValueError(
+                "The persistence length needs backbones of equal length"
+        )
+    return np.concatenate(backbones)
+
+
+def chain_statistics(
+        gsd_file,
+        start=0,
+        stop=-1,
+        stride=1,
+        head_index=0,
+        tail_index=-1,
+        window_size=25,
+        backbone_types=None
+):
+    """Rg, Re and persistence length of every chain from one trajectory read.
+
+    Parameters
+    ----------
+    gsd_file : str
+    start, stop, stride : int
+        Frames trajectory[start:stop:stride] are used for Rg and Re
+    head_index, tail_index : int, default 0 and -1
+        Particles, within a chain, of the end-to-end vector
+    window_size : int or None, default 25
+        The persistence length is fit once per window of window_size
+        consecutive frames of trajectory[start:stop], a partial last window
+        is dropped. None skips the persistence length.
+    backbone_types : list of str, optional
+        Particle types of the backbone used for the persistence length,
+        e.g. ["A"] for select_atoms("name A"). Defaults to all particles.
+
+    Returns
+    -------
+    dict
+        "rg", "re" of shape (n_frames, n_chains), "re_vectors" of shape
+        (n_frames, n_chains, 3), and unless window_size is None, per window
+        "lp", "bond_length" and "bond_autocorrelation". Chains are ordered
+        by length, then by their first particle.
+    """
+    with MultiTrajectory([(gsd_file, slice(start, stop))]) as traj:
+        first = traj[0]
+        groups = chains(first.particles.N, first.bonds.group)
+        if window_size is not None:
+            backbone = _backbone(first, groups, backbone_types)
+            n_bonds = backbone.shape[1] - 1
+
+        rg, re_vectors = [], []
+        windows = []
+        for i in range(len(traj)):
+            positions = traj.read_chunk(i, "particles/position")
+            positions = positions.astype(np.float64)
+            box = traj.read_chunk(i, "configuration/box").astype(np.float64)
+            if i % stride == 0:
+                frame_rg, frame_re = [], []
+                for group in groups:
+                    x = _unwrap_chains(
+                            positions,
+                            _bond_vectors(positions, box, group),
+                            group
+                    )
+                    dx = x - x.mean(axis=1, keepdims=True)
+                    frame_rg.append(
+                            np.sqrt(np.mean(np.sum(dx**2, axis=2), axis=1))
+                    )
+                    frame_re.append(x[:, tail_index] - x[:, head_index])
+                rg.append(np.concatenate(frame_rg))
+                re_vectors.append(np.concatenate(frame_re))
+            if window_size is None:
+                continue
+            if i % window_size == 0:
+                windows.append(
+                        {"corr": np.zeros(n_bonds), "lb": 0.0, "n": 0}
+                )
+            b = _bond_vectors(positions, box, backbone)
+            windows[-1]["corr"] += bond_autocorrelation_sum(b)
+            windows[-1]["lb"] += np.mean(np.linalg.norm(b, axis=-1))
+            windows[-1]["n"] += 1
+
+    re_vectors = np.array(re_vectors)
+    results = {
+        "rg": np.array(rg),
+        "re": np.linalg.norm(re_vectors, axis=-1),
+        "re_vectors": re_vectors,
+    }
+    if window_size is None:
+        return results
+    windows = [w for w in windows if w["n"] == window_size]
+    if len(windows) == 0:
+        raise ValueError(
+                f"Fewer than window_size={window_size} frames to fit the "
+                "persistence length"
+        )
+    # Average over chains, bond pairs at each separation and frames
+    norm = len(backbone) * (n_bonds - np.arange(n_bonds))
+    bond_autocorrelation = np.array(
+            [w["corr"] / (norm * w["n"]) for w in windows]
+    )
+    bond_length = np.array([w["lb"] / w["n"] for w in windows])
+    lp = np.array([
+        fit_persistence_length(corr, lb)
+        for corr, lb in zip(bond_autocorrelation, bond_length)
+    ])
+    results.update(
+            lp=lp,
+            bond_length=bond_length,
+            bond_autocorrelation=bond_autocorrelation
+    )
+    return results
@@ -0,0 +1,267 @@
+"""Several radial distribution functions per trajectory from one neighbor
+query per frame, and many trajectories at once with a process pool.
+
+cmeutils.structure.gsd_rdf computes one RDF per call and re-reads the
+trajectory every time. Here the RDFs requested for the same pair of
+particle types share a single freud AABBQuery per frame, done up to the
+largest r_max among them. Every RDF, with or without bonded exclusions and
+with its own r_max and bins, is then a histogram of a slice of the same
+neighbor distances.
+
+Examples
+--------
+>>> specs = [RDFSpec("A", "A", r_max=6), RDFSpec("A", "A", r_max=6,
+...          exclude_bonded=False)]
+>>> results = job_rdfs(project.find_jobs({"density": 1.35}), specs,
+...                    start=10, stop=20)
+>>> bin_centers, g = results[job.id]["A-A_6.0_excluded"].T
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from .distributions import bonded_exclusions
+from .trajectory import MultiTrajectory, _source_stamp
+
+
+class RDFSpec:
+    """One RDF to compute.
+
+    Parameters
+    ----------
+    type1, type2 : str
+        Particle types, type2 particles are the query points
+    r_max : float
+    bins : int, default 100
+    r_min : float, default 0
+    exclude_bonded : bool, default True
+        Drop pairs in the same molecule and rescale by the fraction of pairs
+        kept, like gsd_rdf(exclude_bonded=True)
+    max_bonds : int, optional
+        Only drop pairs at most max_bonds bonds apart, see BondedExclusions
+    normalization : str, default "exact"
+        freud's normalization_mode. "exact", as in gsd_rdf, uses the density
+        of all type1 particles. "finite_size" leaves the query particle
+        itself out of it for same type pairs.
+    name : str, optional
+        Key of the result, defaults to e.g. "A-A_6.0_excluded", or
+        "A-A_6.0_excluded3" with max_bonds=3
+    """
+    def __init__(
+            self,
+            type1,
+            type2,
+            r_max,
+            bins=100,
+            r_min=0.0,
+            exclude_bonded=True,
+            max_bonds=None,
+            normalization="exact",
+            name=None
+    ):
+        self.type1 = type1
+        self.type2 = type2
+        self.r_max = float(r_max)
+        self.bins = int(bins)
+        self.r_min = float(r_min)
+        self.exclude_bonded = exclude_bonded
+        self.max_bonds = max_bonds
+        if normalization not in ("exact", "finite_size"):
+            raise ValueError("normalization must be exact or finite_size")
+        self.normalization = normalization
+        if name is None:
+            kind = "excluded" if exclude_bonded else "all"
+            if exclude_bonded and max_bonds is not None:
+                kind += str(max_bonds)
+            name = f"{type1}-{type2}_{self.r_max}_{kind}"
+        self.name = name
+
+    def as_dict(self):
+        return dict(vars(self))
+
+    @property
+    def bin_edges(self):
+        return np.linspace(self.r_min, self.r_max, self.bins + 1)
+
+
+def _normalize(counts, spec, n_query, n_points, volume, n_frames):
+    """g(r) from pair counts summed over frames, like freud's RDF with
+    normalization_mode=spec.normalization."""
+    edges = spec.bin_edges
+    shell = 4 / 3 * np.pi * (edges[1:] ** 3 - edges[:-1] ** 3)
+    if spec.normalization == "finite_size" and spec.type1 == spec.type2:
+        n_points = n_points - 1
+    density = n_points / volume
+    return counts / (n_frames * n_query * density * shell)
+
+
+def rdfs(gsdfile, specs, start=0, stop=None, stride=1):
+    """Compute every RDF in specs from one read of a trajectory.
+
+    Parameters
+    ----------
+    gsdfile : str
+    specs : list of RDFSpec
+    start, stop, stride : int, optional
+        Frames trajectory[start:stop:stride] are used
+
+    Returns
+    -------
+    dict
+        spec.name: (bins, 2) array of bin centers and g(r)
+    """
+    import freud
+
+    names = [spec.name for spec in specs]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"RDFSpec names must be unique, got {duplicates}")
+    with MultiTrajectory([(gsdfile, slice(start, stop, stride))]) as traj:
+        first = traj[0]
+        types = list(first.particles.types)
+        typeid = np.asarray(first.particles.typeid)
+        exclusions = {
+            spec.max_bonds: bonded_exclusions(first, spec.max_bonds)
+            for spec in specs if spec.exclude_bonded
+        }
+        pairs = dict()
+        for spec in specs:
+            pairs.setdefault((spec.type1, spec.type2), []).append(spec)
+        selections = {
+            name: np.nonzero(typeid == types.index(name))[0]
+            for pair in pairs for name in pair
+        }
+
+        counts = {spec.name: np.zeros(spec.bins) for spec in specs}
+        n_pairs = {spec.name: 0 for spec in specs}
+        n_kept = {spec.name: 0 for spec in specs}
+        volume = 0.0
+        for i in range(len(traj)):
+            box = freud.box.Box(*traj.read_chunk(i, "configuration/box"))
+            positions = traj.read_chunk(i, "particles/position")
+            volume += box.volume
+            for (type1, type2), pair_specs in pairs.items():
+                A, B = selections[type1], selections[type2]
+                r_max = max(spec.r_max for spec in pair_specs)
+                aq = freud.locality.AABBQuery(box, positions[A])
+                nlist = aq.query(
+                        positions[B],
+                        {"r_max": r_max, "exclude_ii": type1 == type2}
+                ).toNeighborList()
+                distances = np.asarray(nlist.distances)
+                point_ids = A[nlist.point_indices]
+                query_ids = B[nlist.query_point_indices]
+                bonded = {
+                    max_bonds: exclusion.excluded(point_ids, query_ids)
+                    for max_bonds, exclusion in exclusions.items()
+                }
+                for spec in pair_specs:
+                    in_range = distances < spec.r_max
+                    keep = in_range
+                    if spec.exclude_bonded:
+                        keep = in_range & ~bonded[spec.max_bonds]
+                        n_pairs[spec.name] += np.count_nonzero(in_range)
+                        n_kept[spec.name] += np.count_nonzero(keep)
+                    counts[spec.name] += np.histogram(
+                            distances[keep], bins=spec.bin_edges
+                    )[0]
+        n_frames = len(traj)
+
+    results = dict()
+    for spec in specs:
+        g = _normalize(
+                counts[spec.name],
+                spec,
+                len(selections[spec.type2]),
+                len(selections[spec.type1]),
+                volume / n_frames,
+                n_frames
+        )
+        if n_pairs[spec.name] > 0:
+            g *= n_kept[spec.name] / n_pairs[spec.name]
+        edges = spec.bin_edges
+        bin_centers = (edges[1:] + edges[:-1]) / 2
+        results[spec.name] = np.column_stack([bin_centers, g])
+    return results
+
+
+def _cache_path(gsdfile, specs, start, stop, stride):
+    key = json.dumps(
+            {
+                "specs": [spec.as_dict() for spec in specs],
+                "frames": [start, stop, stride],
+                "source": _source_stamp(gsdfile).tolist(),
+            },
+            sort_keys=True
+    )
+    digest = hashlib.sha1(key.encode()).hexdigest()[:16]
+    return os.path.join(os.path.dirname(gsdfile), f"rdf-{digest}.npz")
+
+
+def cached_rdfs(gsdfile, specs, start=0, stop=None, stride=1):
+    """rdfs, saved to an rdf-<hash>.npz file next to gsdfile and read from it
+    again while the specs, frames and trajectory stay the same."""
+    fpath = _cache_path(gsdfile, specs, start, stop, stride)
+    if os.path.isfile(fpath):
+        with np.load(fpath) as cached:
+            return {name: cached[name] for name in cached.files}
+    results = rdfs(gsdfile, specs, start=start, stop=stop, stride=stride)
+    tmp_path = fpath + ".tmp.npz"
+    np.savez(tmp_path, **results)
+    os.replace(tmp_path, fpath)
+    return results
+
+
+def batch_rdfs(
+        gsdfiles,
+        specs,
+        start=0,
+        stop=None,
+        stride=1,
+        n_workers=None,
+        cache=True
+):
+    """rdfs of every trajectory in gsdfiles, computed in a process pool.
+
+    Returns a list of results in the order of gsdfiles.
+    """
+    function = cached_rdfs if cache else rdfs
+    gsdfiles = list(gsdfiles)
+    if n_workers == 1 or len(gsdfiles) < 2:
+        return [function(f, specs, start, stop, stride) for f in gsdfiles]
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = [
+            pool.submit(function, f, specs, start, stop, stride)
+            for f in gsdfiles
+        ]
+        return [future.result() for future in futures]
+
+
+def job_rdfs(
+        jobs,
+        specs,
+        gsd_name="production.gsd",
+        start=0,
+        stop=None,
+        stride=1,
+        n_workers=None,
+        cache=True
+):
+    """batch_rdfs of one trajectory of every signac job.
+
+    Returns a dict of job id: rdfs result.
+    """
+    jobs = [job for job in jobs if job.isfile(gsd_name)]
+    results = batch_rdfs(
+            [job.fn(gsd_name) for job in jobs],
+            specs,
+            start=start,
+            stop=stop,
+            stride=stride,
+            n_workers=n_workers,
+            cache=cache
+    )
+    return {job.id: result for job, result in zip(jobs, results)}
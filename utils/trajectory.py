@@ -0,0 +1,283 @@
+import os
+
+import gsd.hoomd
+import numpy as np
+
+from .coarse_grain import _unwrap
+
+
+class MultiTrajectory:
+    """Several GSD files, or frame ranges of them, as one sequence of frames.
+
+    Frames are read from the original files on demand, nothing is copied.
+    Indexing with an int returns a gsd.hoomd.Frame, indexing with a slice
+    or an array of indices returns another MultiTrajectory view that shares
+    the open file handles.
+
+    Parameters
+    ----------
+    sources : list
+        Each item is either a path to a GSD file (use every frame) or a
+        tuple of (path, frames) where frames is an int, slice, range or
+        list of frame indices in that file.
+
+    Examples
+    --------
+    Put the first frame of the initial NPT run in front of the last NVT run:
+
+    >>> traj = MultiTrajectory([
+    ...     (job.fn("trajectory-npt0.gsd"), 0),
+    ...     job.fn("trajectory-nvt2.gsd")
+    ... ])
+    """
+    def __init__(self, sources, _handles=None, _index=None):
+        self._paths = []
+        for source in sources:
+            path = source[0] if isinstance(source, tuple) else source
+            if path not in self._paths:
+                self._paths.append(path)
+        self._handles = dict() if _handles is None else _handles
+        if _index is not None:
+            self._index = _index
+            return
+        file_ids = []
+        frames = []
+        for source in sources:
+            if isinstance(source, tuple):
+                path, selection = source
+            else:
+                path, selection = source, slice(None)
+            n_frames = len(self._handle(path))
+            if isinstance(selection, (int, np.integer)):
+                selection = [selection]
+            if isinstance(selection, slice):
+                selection = range(*selection.indices(n_frames))
+            selection = np.asarray(selection, dtype=np.int64)
+            selection[selection < 0] += n_frames
+            file_ids.append(
+                    np.full(len(selection), self._paths.index(path))
+            )
+            frames.append(selection)
+        if len(frames) == 0:
+            self._index = np.empty((0, 2), dtype=np.int64)
+        else:
+            self._index = np.column_stack(
+                    [np.concatenate(file_ids), np.concatenate(frames)]
+            )
+
+    def _handle(self, path):
+        if path not in self._handles:
+            self._handles[path] = gsd.hoomd.open(path, "r")
+        return self._handles[path]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            file_id, frame = self._index[key]
+            return self._handle(self._paths[file_id])[int(frame)]
+        view = MultiTrajectory(
+                self._paths, _handles=self._handles, _index=self._index[key]
+        )
+        return view
+
+    def __iter__(self):
+        for file_id, frame in self._index:
+            yield self._handle(self._paths[file_id])[int(frame)]
+
+    def read_chunk(self, index, name):
+        """Read one data chunk, e.g. "particles/position", of a frame
+        without building a gsd.hoomd.Frame.
+
+        Falls back to frame 0 of the same file if the chunk isn't stored
+        in that frame, like gsd.hoomd does. Returns None if it isn't found.
+        """
+        file_id, frame = self._index[index]
+        gsd_file = self._handle(self._paths[file_id]).file
+        for idx in (int(frame), 0):
+            if gsd_file.chunk_exists(frame=idx, name=name):
+                return gsd_file.read_chunk(frame=idx, name=name)
+        return None
+
+    @property
+    def frame_sources(self):
+        """List of (path, frame index) for every frame in the sequence."""
+        return [
+            (self._paths[file_id], int(frame))
+            for file_id, frame in self._index
+        ]
+
+    def close(self):
+        for handle in self._handles.values():
+            handle.close()
+        self._handles.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def job_trajectory(job, ensemble="nvt", run=None, prepend_first_frame=True):
+    """The trajectory of one run of a validation job as a MultiTrajectory.
+
+    Parameters
+    ----------
+    job : signac.job.Job
+    ensemble : str, default "nvt"
+        Either "npt" or "nvt"
+    run : int, optional
+        Run number to use, defaults to the last run of the ensemble
+    prepend_first_frame : bool, default True
+        Put frame 0 of trajectory-npt0.gsd in front of the run, which is what
+        the combined-*.gsd and temp-npt.gsd files used to be made for.
+    """
+    if run is None:
+        run = job.doc[f"{ensemble}_runs"] - 1
+    sources = []
+    fpath = job.fn(f"trajectory-{ensemble}{run}.gsd")
+    init_path = job.fn("trajectory-npt0.gsd")
+    if prepend_first_frame and fpath != init_path:
+        sources.append((init_path, 0))
+    sources.append(fpath)
+    return MultiTrajectory(sources)
+
+
+def unwrapped_prefix(gsdfile):
+    """Default path prefix of the UnwrappedTrajectory of a GSD file."""
+    root, _ = os.path.splitext(gsdfile)
+    return f"{root}-unwrapped"
+
+
+def _source_stamp(gsdfile):
+    stat = os.stat(gsdfile)
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def write_unwrapped(gsdfile, prefix=None, start=0, stop=None):
+    """Convert a GSD trajectory to an UnwrappedTrajectory store.
+
+    Writes three files next to each other:
+
+        {prefix}-positions.npy  float32 (n_frames, N, 3), unwrapped
+        {prefix}-images.npy     int32 (n_frames, N, 3)
+        {prefix}-meta.npz       box and step of every frame, the particle
+                                types and bonds of the first frame and the
+                                size and mtime of the GSD file
+
+    Only the position, image, box and step chunks are decoded, one frame
+    at a time, so the trajectory never has to fit in memory.
+
+    Parameters
+    ----------
+    gsdfile : str
+    prefix : str, optional
+        Defaults to the GSD path without .gsd plus "-unwrapped"
+    start, stop : int, optional
+        Frame range to convert
+    """
+    from numpy.lib.format import open_memmap
+
+    if prefix is None:
+        prefix = unwrapped_prefix(gsdfile)
+    with MultiTrajectory([(gsdfile, slice(start, stop))]) as traj:
+        n_frames = len(traj)
+        n_particles = len(traj.read_chunk(0, "particles/position"))
+        shape = (n_frames, n_particles, 3)
+        positions = open_memmap(
+                f"{prefix}-positions.npy",
+                mode="w+",
+                dtype=np.float32,
+                shape=shape
+        )
+        images = open_memmap(
+                f"{prefix}-images.npy", mode="w+", dtype=np.int32, shape=shape
+        )
+        box = np.zeros((n_frames, 6), dtype=np.float32)
+        step = np.zeros(n_frames, dtype=np.uint64)
+        for i in range(n_frames):
+            box[i] = traj.read_chunk(i, "configuration/box")
+            step_chunk = traj.read_chunk(i, "configuration/step")
+            step[i] = 0 if step_chunk is None else step_chunk[0]
+            image = traj.read_chunk(i, "particles/image")
+            images[i] = 0 if image is None else image
+            # Unwrap in double precision before storing as float32
+            positions[i] = _unwrap(
+                    traj.read_chunk(i, "particles/position")[None],
+                    images[i][None],
+                    box[i].astype(np.float64)
+            )[0]
+        positions.flush()
+        images.flush()
+        del positions, images
+        first = traj[0]
+        np.savez(
+                f"{prefix}-meta.npz",
+                box=box,
+                step=step,
+                frames=traj._index[:, 1].copy(),
+                types=np.array(first.particles.types),
+                typeid=np.asarray(first.particles.typeid),
+                bonds=np.asarray(first.bonds.group).reshape(-1, 2),
+                source=_source_stamp(gsdfile)
+        )
+    return UnwrappedTrajectory(prefix)
+
+
+class UnwrappedTrajectory:
+    """Read only, memory mapped view of a store written by write_unwrapped.
+
+    positions and images are np.memmap arrays of shape (n_frames, N, 3),
+    so slicing them, e.g. positions[100:300], reads only those frames and
+    copies nothing. Several analyses can share one store instead of each
+    decoding the GSD file again.
+
+    Examples
+    --------
+    >>> store = UnwrappedTrajectory.for_gsd(job.fn("production.gsd"))
+    >>> if store is None:
+    ...     store = write_unwrapped(job.fn("production.gsd"))
+    >>> window = store.positions[100:300]
+    """
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.positions = np.load(f"{prefix}-positions.npy", mmap_mode="r")
+        self.images = np.load(f"{prefix}-images.npy", mmap_mode="r")
+        with np.load(f"{prefix}-meta.npz") as meta:
+            self.box = meta["box"]
+            self.step = meta["step"]
+            self.frames = meta["frames"]
+            self.types = [str(t) for t in meta["types"]]
+            self.typeid = meta["typeid"]
+            self.bonds = meta["bonds"]
+            self.source = meta["source"]
+
+    @classmethod
+    def for_gsd(cls, gsdfile, prefix=None):
+        """The store of gsdfile, or None if there is none or the GSD file
+        changed since it was written."""
+        if prefix is None:
+            prefix = unwrapped_prefix(gsdfile)
+        if not os.path.isfile(f"{prefix}-meta.npz"):
+            return None
+        store = cls(prefix)
+        if not np.array_equal(store.source, _source_stamp(gsdfile)):
+            return None
+        return store
+
+    def __len__(self):
+        return len(self.positions)
+
+    @property
+    def n_particles(self):
+        return self.positions.shape[1]
+
+    def wrapped_positions(self, index):
+        """Positions of one frame wrapped back into the box."""
+        return _unwrap(
+                self.positions[index][None],
+                -self.images[index][None],
+                self.box[index].astype(np.float64)
+        )[0].astype(np.float32)
@@ -1,10 +1,18 @@
 import numpy as np
-from cmeutils.sampling import is_equilibrated
+
+from .logs import LogCache, LogTail
+from .sampling import is_equilibrated
 
 
 def combine_log_files(job, ensemble="npt",
                       value="mdcomputeThermodynamicQuantitiesvolume"):
-    arrays = []
+    """Concatenate log columns across all runs of an ensemble.
+
+    `value` can be a single column name, in which case one array is
+    returned, or a list of column names, in which case a dict of
+    column name: array is returned. Each log file is only read once
+    no matter how many columns are requested.
+    """
     if ensemble == "npt":
         n_runs = job.doc.npt_runs
     elif ensemble == "nvt":
@@ -12,29 +20,33 @@ def combine_log_files(job, ensemble="npt",
     else:
         raise ValueError(f"Unknown ensemble {ensemble}")
 
+    values = [value] if isinstance(value, str) else list(value)
+    arrays = {v: [] for v in values}
     for i in range(n_runs):
-        fpath = job.fn(f"log-{ensemble}{i}.txt")
-        data = np.genfromtxt(fpath, names=True)
-        data_array = data[value]
-        arrays.append(data_array)
-    return np.concatenate(arrays)
+        columns = LogCache(job.fn(f"log-{ensemble}{i}.txt")).columns(values)
+        for v in values:
+            arrays[v].append(columns[v])
+    combined = {v: np.concatenate(arrays[v]) for v in values}
+    if isinstance(value, str):
+        return combined[value]
+    return combined
 
 
 def check_npt_equilibration(job, sample_idx):
-    volume = combine_log_files(job,
-                               ensemble="npt",
-                               value="mdcomputeThermodynamicQuantitiesvolume")
-    potential_energy = combine_log_files(job,
-                                         ensemble="npt",
-                                         value="mdcomputeThermodynamicQuantitiespotential_energy")
-
-    vol_eq = is_equilibrated(volume[sample_idx:],
-                             threshold_fraction=0.15,
-                             threshold_neff=200)[0]
-    pe_eq = is_equilibrated(potential_energy[sample_idx:],
-                            threshold_fraction=0.15,
-                            threshold_neff=200)[0]
-    return all([vol_eq, pe_eq])
+    data = combine_log_files(
+            job,
+            ensemble="npt",
+            value=[
+                "mdcomputeThermodynamicQuantitiesvolume",
+                "mdcomputeThermodynamicQuantitiespotential_energy"
+            ]
+    )
+    return all([
+        is_equilibrated(values[sample_idx:],
+                        threshold_fraction=0.15,
+                        threshold_neff=200)[0]
+        for values in data.values()
+    ])
 
 
 def check_nvt_equilibration(job, sample_idx):
@@ -47,3 +59,80 @@ def check_nvt_equilibration(job, sample_idx):
                             threshold_neff=200)[0]
     return pe_eq
 
+
+class EquilibrationMonitor:
+    """Online equilibration check for a run that is still in progress.
+
+    Loads the log columns of all previous runs of `ensemble` once, then
+    follows the log file of the current run with a LogTail so that each
+    call to `check` only parses the newly written rows before running
+    is_equilibrated on every column.
+
+    Parameters
+    ----------
+    job : signac.job.Job
+        The job being simulated
+    log_path : str
+        Path to the log file of the run in progress
+    ensemble : str, default "npt"
+        Used to find the log files of the previous runs
+    values : list of str
+        Log columns that all need to be equilibrated
+    sample_idx : int, default 0
+        Index of the combined log data to start checking from
+    threshold_fraction : float, default 0.15
+    threshold_neff : int, default 200
+    """
+    def __init__(
+            self,
+            job,
+            log_path,
+            ensemble="npt",
+            values=(
+                "mdcomputeThermodynamicQuantitiesvolume",
+                "mdcomputeThermodynamicQuantitiespotential_energy"
+            ),
+            sample_idx=0,
+            threshold_fraction=0.15,
+            threshold_neff=200
+    ):
+        self.values = list(values)
+        self.sample_idx = sample_idx
+        self.threshold_fraction = threshold_fraction
+        self.threshold_neff = threshold_neff
+        self.tail = LogTail(log_path)
+        if job.doc.get(f"{ensemble}_runs", 0) > 0:
+            previous = combine_log_files(
+                    job, ensemble=ensemble, value=self.values
+            )
+            self._data = {value: [previous[value]] for value in self.values}
+        else:
+            self._data = {value: [] for value in self.values}
+
+    def update(self):
+        new_rows = self.tail.read()
+        for value in self.values:
+            if value in new_rows:
+                self._data[value].append(new_rows[value])
+        return new_rows
+
+    def data(self, value):
+        """All of the data collected so far for one log column."""
+        if len(self._data[value]) == 0:
+            return np.empty(0)
+        return np.concatenate(self._data[value])
+
+    def check(self):
+        """Read any new log rows and check if every column is equilibrated."""
+        self.update()
+        for value in self.values:
+            data = self.data(value)[self.sample_idx:]
+            if len(data) < self.threshold_neff:
+                return False
+            if not is_equilibrated(
+                    data,
+                    threshold_fraction=self.threshold_fraction,
+                    threshold_neff=self.threshold_neff
+            )[0]:
+                return False
+        return True
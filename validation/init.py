@@ -94,6 +94,9 @@ def main():
         job.doc.setdefault("nvt_equilibrated", False)
         job.doc.setdefault("npt_runs", 0)
         job.doc.setdefault("nvt_runs", 0)
+        # Set to a number of steps to run the longer NPT/NVT runs in chunks
+        # of this size and stop early once the log data is equilibrated
+        job.doc.setdefault("equil_check_steps", None)
 
 
 if __name__ == "__main__":
@@ -73,6 +73,22 @@ def nvt_equilibrated(job):
     return job.doc.nvt_equilibrated
 
 
+@MyProject.label
+def cg_targets_done(job):
+    """All CG targets exist and are newer than the trajectories they are
+    made from."""
+    if job.doc.nvt_runs < 1:
+        return False
+    sources = [f for f in cg_source_files(job) if os.path.isfile(f)]
+    source_mtime = max([os.path.getmtime(f) for f in sources], default=0)
+    for cg_file_name in CG_MAPPINGS:
+        if not job.isfile(cg_file_name):
+            return False
+        if os.path.getmtime(job.fn(cg_file_name)) < source_mtime:
+            return False
+    return True
+
+
 def get_ref_values(job):
     ref_length = job.doc.ref_length * Unit(job.doc.ref_length_units)
     ref_mass = job.doc.ref_mass * Unit(job.doc.ref_mass_units)
@@ -84,9 +100,85 @@ def get_ref_values(job):
     }
     return ref_values_dict
 
-def coarse_grain_trajectory(job, gsd_file):
-    import grits
-    pass
+
+def run_until_equilibrated(sim, run_func, n_steps, chunk_steps, monitor,
+                           **run_kwargs):
+    """Run n_steps in chunks of chunk_steps, stopping early once the monitor
+    finds the log data equilibrated.
+
+    Only the first chunk goes through run_func (e.g. sim.run_NPT), which
+    sets up the integrator method. Later chunks continue it with sim.run,
+    so the thermostat and barostat state carries over between chunks and
+    no extra log rows are written at chunk boundaries.
+    """
+    steps_run = 0
+    while steps_run < n_steps:
+        steps = int(min(chunk_steps, n_steps - steps_run))
+        if steps_run == 0:
+            run_func(n_steps=steps, **run_kwargs)
+        else:
+            sim.run(steps)
+        steps_run += steps
+        sim.flush_writers()
+        if monitor.check():
+            print(f"Equilibrated after {steps_run} steps.")
+            return True
+    return False
+
+
+# CG target file name: SMARTS string of the bead used to make it
+CG_MAPPINGS = {
+    "target_1monomer_per_bead.gsd": "c1ccc(S)cc1",
+    "target_2monomer_per_bead.gsd": "c1ccc(S(c2ccc(S)cc2))cc1",
+}
+
+
+def cg_source_files(job):
+    """Atomistic trajectory files that the CG targets are made from."""
+    return [
+        job.fn("trajectory-npt0.gsd"),
+        job.fn(f"trajectory-nvt{job.doc.nvt_runs - 1}.gsd")
+    ]
+
+
+def coarse_grain_trajectory(job, cg_file_name, bead_smarts, scale_units=False):
+    """Map the last NVT run (with the first NPT frame in front of it)
+    to a CG trajectory with one bead type "A" matching bead_smarts.
+
+    If scale_units is True, lengths and masses of the CG trajectory are
+    converted to real units with job.doc.ref_length and job.doc.ref_mass.
+    """
+    import ele
+    from utils import MultiTrajectory
+    from utils.coarse_grain import cached_bead_mapping
+    from utils.coarse_grain import coarse_grain_trajectory as write_cg_gsd
+
+    conv_dict = {
+        "ca": ele.element_from_symbol("C"),
+        "s": ele.element_from_symbol("S"),
+        "sh": ele.element_from_symbol("S"),
+        "ha": ele.element_from_symbol("H"),
+        "hs": ele.element_from_symbol("H"),
+    }
+    init_file, last_file = cg_source_files(job)
+    # Every job has the same system, so the SMARTS matching is only done
+    # once and shared through the project level mapping cache
+    mapping = cached_bead_mapping(
+        gsdfile=init_file,
+        beads={"A": bead_smarts},
+        cache_dir=os.path.join(job.project.path, "bead-mappings"),
+        conversion_dict=conv_dict,
+        add_hydrogens=job.sp.remove_hydrogens
+    )
+    with MultiTrajectory([(init_file, 0), last_file]) as traj:
+        write_cg_gsd(
+                traj=traj,
+                mapping=mapping,
+                cg_gsdfile=job.fn(cg_file_name),
+                length_scale=job.doc.ref_length if scale_units else 1.0,
+                mass_scale=job.doc.ref_mass if scale_units else 1.0
+        )
+    return mapping
 
 
 @MyProject.post(initial_npt_run_done)
@@ -218,6 +310,7 @@ def run_npt_longer(job):
     from flowermd.base.system import Pack
     from flowermd.library import PPS, OPLS_AA_PPS
     from flowermd.base.simulation import Simulation
+    from utils import EquilibrationMonitor
     with job:
         print("------------------------------------")
         print("JOB ID NUMBER:")
@@ -243,14 +336,35 @@ def run_npt_longer(job):
                 seed=job.sp.sim_seed,
         )
         print("Running NPT simulation.")
-        sim.run_NPT(
-            n_steps=1e8,
+        npt_kwargs = dict(
             kT=job.sp.kT,
             pressure=job.doc.pressure,
             tau_kt=job.doc.tau_kT,
             tau_pressure=job.doc.tau_pressure,
             gamma=job.sp.gamma
         )
+        chunk_steps = job.doc.get("equil_check_steps")
+        if chunk_steps:
+            # Run in chunks and stop as soon as volume and PE are equilibrated
+            monitor = EquilibrationMonitor(
+                    job=job,
+                    log_path=log_path,
+                    ensemble="npt",
+                    sample_idx=job.doc.get("npt_sample_idx", 0)
+            )
+            is_equilibrated = run_until_equilibrated(
+                    sim=sim,
+                    run_func=sim.run_NPT,
+                    n_steps=1e8,
+                    chunk_steps=chunk_steps,
+                    monitor=monitor,
+                    **npt_kwargs
+            )
+            if is_equilibrated:
+                print("NPT simulation equilibrated.")
+                job.doc.npt_equilibrated = True
+        else:
+            sim.run_NPT(n_steps=1e8, **npt_kwargs)
         sim.save_restart_gsd(job.fn("restart-npt.gsd"))
         job.doc.npt_runs += 1
         print("Simulation finished.")
@@ -323,6 +437,7 @@ def run_nvt_longer(job):
     from unyt import Unit
     import flowermd 
     from flowermd.base.simulation import Simulation
+    from utils import EquilibrationMonitor
     with job:
         print("------------------------------------")
         print("JOB ID NUMBER:")
@@ -346,11 +461,66 @@ def run_nvt_longer(job):
                 log_file_name=log_path,
                 seed=job.sp.sim_seed,
         )
-        sim.run_NVT(n_steps=1e7, kT=job.sp.kT, tau_kt=job.doc.tau_kT)
+        chunk_steps = job.doc.get("equil_check_steps")
+        if chunk_steps:
+            # Run in chunks and stop as soon as PE is equilibrated
+            monitor = EquilibrationMonitor(
+                    job=job,
+                    log_path=log_path,
+                    ensemble="nvt",
+                    values=["mdcomputeThermodynamicQuantitiespotential_energy"],
+                    sample_idx=job.doc.get("nvt_sample_idx", 0)
+            )
+            is_equilibrated = run_until_equilibrated(
+                    sim=sim,
+                    run_func=sim.run_NVT,
+                    n_steps=1e7,
+                    chunk_steps=chunk_steps,
+                    monitor=monitor,
+                    kT=job.sp.kT,
+                    tau_kt=job.doc.tau_kT
+            )
+            if is_equilibrated:
+                print("NVT simulation equilibrated.")
+                job.doc.nvt_equilibrated = True
+        else:
+            sim.run_NVT(n_steps=1e7, kT=job.sp.kT, tau_kt=job.doc.tau_kT)
         sim.save_restart_gsd(job.fn("restart-nvt.gsd"))
         job.doc.nvt_runs += 1
         print("Simulation finished.")
 
 
+@MyProject.pre(nvt_equilibrated)
+@MyProject.post(cg_targets_done)
+@MyProject.operation(
+        directives={"ngpu": 0, "np": 1, "executable": "python -u"},
+        name="coarse-grain"
+)
+def coarse_grain(job):
+    """Make the CG target trajectories used by the MSIBI projects.
+
+    This is CPU only; bundle it across cores with
+    `python project.py submit -o coarse-grain --bundle N --parallel`
+    """
+    with job:
+        print("------------------------------------")
+        print("JOB ID NUMBER:")
+        print(job.id)
+        print("------------------------------------")
+        cg_mappings = job.doc.get("cg_mappings", dict())
+        for cg_file_name, bead_smarts in CG_MAPPINGS.items():
+            print(f"Coarse-graining to {cg_file_name}...")
+            mapping = coarse_grain_trajectory(job, cg_file_name, bead_smarts)
+            cg_mappings[cg_file_name] = {
+                "beads": {"A": bead_smarts},
+                "source_files": [
+                    os.path.basename(f) for f in cg_source_files(job)
+                ],
+                "n_beads": sum([len(beads) for beads in mapping.values()]),
+            }
+        job.doc.cg_mappings = cg_mappings
+        print("Coarse-graining finished.")
+
+
 if __name__ == "__main__":
     MyProject(environment=Fry).main()